@@ -0,0 +1,275 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import statistics
+from io import BytesIO
+
+# ---------------- Arguments ----------------
+parser = argparse.ArgumentParser(description="OmniTrending load test against local DexScreener/logo/Telegram stand-ins")
+parser.add_argument("--users", type=int, default=200, help="synthetic users, each runs the full flow once")
+parser.add_argument("--concurrency", type=int, default=20, help="users running the flow at the same time")
+parser.add_argument("--api-latency", type=float, default=50, help="milliseconds the mock DexScreener takes per request")
+parser.add_argument("--telegram-latency", type=float, default=20, help="milliseconds the mock Telegram API takes per call")
+parser.add_argument("--tokens", type=int, default=50, help="distinct contract addresses the users pick from")
+parser.add_argument("--port", type=int, default=18080, help="port for the mock servers")
+parser.add_argument("--real-limits", action="store_true", help="keep Telegram send rate limits (off by default)")
+parser.add_argument("--micro-only", action="store_true", help="only run the microbenchmarks")
+args = parser.parse_args()
+
+# ---------------- Environment ----------------
+# main.py reads its settings at import time, so point it at the mocks first
+MOCK_URL = f"http://127.0.0.1:{args.port}"
+SUPPORT_CHAT = -1001
+SUPPORT_USER = 999
+bench_dir = tempfile.mkdtemp(prefix="omnitrending-bench-")
+os.environ.update({
+    "BOT_TOKEN": "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMARK",
+    "SUPPORT_CHAT": str(SUPPORT_CHAT),
+    "DEXSCREENER_API_URL": MOCK_URL,
+    "MARKET_PROVIDERS": "dexscreener",
+    "TELEGRAM_API_URL": MOCK_URL,
+    "DB_PATH": os.path.join(bench_dir, "bench.db"),
+    "METRICS_PORT": "0",
+})
+for name in ("LEADERBOARD_CHAT", "LOGO_CACHE_DIR", "RUN_MODE"):
+    os.environ.pop(name, None)
+if not args.real_limits:
+    os.environ.update({"SEND_GLOBAL_RATE": "100000", "SEND_CHAT_RATE": "100000", "SEND_GROUP_RATE": "100000"})
+
+from aiohttp import web
+from PIL import Image
+from aiogram import Bot, Dispatcher, types
+import main
+
+# ---------------- Mock Services ----------------
+def token_address(i):
+    return "0x" + f"{i:040x}"
+
+def make_pair(address, chain_id, liquidity):
+    n = int(address, 16) if address.startswith("0x") else len(address)
+    return {
+        "chainId": chain_id,
+        "dexId": "uniswap",
+        "pairAddress": f"0xpair{n:x}{chain_id}",
+        "baseToken": {"address": address, "name": f"Bench Token {n}", "symbol": f"BT{n}"},
+        "quoteToken": {"address": "0x" + "e" * 40, "name": "Wrapped Ether", "symbol": "WETH"},
+        "priceUsd": "0.00001234",
+        "priceChange": {"h1": 1.5, "h6": -3.2, "h24": 12.8},
+        "volume": {"h24": 1234567},
+        "liquidity": {"usd": liquidity},
+        "fdv": 9876543,
+        "marketCap": 8765432,
+        "info": {"imageUrl": f"{MOCK_URL}/logo/{n % 10}.png"},
+    }
+
+def make_logo():
+    img = Image.new("RGBA", (512, 512), (30, 144, 255, 255))
+    for x in range(0, 512, 8):
+        for y in range(0, 512, 8):
+            img.putpixel((x, y), (x % 256, y % 256, 128, 200))
+    bio = BytesIO()
+    img.save(bio, format="PNG")
+    return bio.getvalue()
+
+class MockServices:
+    def __init__(self):
+        self.logo = make_logo()
+        self.message_id = 0
+        self.calls = {}
+        self.activations = {}  # user id -> activate_ callback data seen in the support chat
+
+    async def dexscreener(self, request):
+        await asyncio.sleep(args.api_latency / 1000)
+        pairs = []
+        for address in request.match_info["addresses"].split(","):
+            pairs.append(make_pair(address, "ethereum", 50_000))
+            pairs.append(make_pair(address, "ethereum", 250_000))
+            pairs.append(make_pair(address, "base", 10_000))
+        return web.json_response({"pairs": pairs})
+
+    async def logo_file(self, request):
+        return web.Response(body=self.logo, content_type="image/png")
+
+    async def telegram(self, request):
+        await asyncio.sleep(args.telegram_latency / 1000)
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await request.post()
+        if method in ("sendMessage", "sendPhoto", "editMessageText"):
+            return web.json_response({"ok": True, "result": self.message(method, data)})
+        return web.json_response({"ok": True, "result": True})
+
+    def message(self, method, data):
+        chat_id = int(data.get("chat_id", 0))
+        self.message_id += 1
+        message = {
+            "message_id": int(data.get("message_id") or self.message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "text": data.get("text") or "",
+        }
+        if method == "sendPhoto":
+            file_id = data["photo"] if isinstance(data.get("photo"), str) else f"photo{self.message_id}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 300, "height": 300}]
+            message["caption"] = data.get("caption") or ""
+        markup = data.get("reply_markup")
+        if chat_id == SUPPORT_CHAT and markup:
+            for row in json.loads(markup)["inline_keyboard"]:
+                for button in row:
+                    callback = button.get("callback_data") or ""
+                    if callback.startswith("activate_"):
+                        self.activations[int(callback.split("_")[1])] = (callback, message)
+        return message
+
+    def app(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_get("/latest/dex/tokens/{addresses}", self.dexscreener)
+        app.router.add_get("/logo/{name}", self.logo_file)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        return app
+
+# ---------------- Synthetic Users ----------------
+update_ids = iter(range(1, 10**9))
+
+def user_dict(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+def message_update(user_id, text):
+    message = {"message_id": next(update_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user_dict(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return types.Update(update_id=next(update_ids), message=message)
+
+def callback_update(user_id, data, message=None):
+    if message is None:
+        message = {"message_id": next(update_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "text": "..."}
+    return types.Update(update_id=next(update_ids), callback_query={
+        "id": str(next(update_ids)), "from": user_dict(user_id), "chat_instance": "bench", "data": data, "message": message,
+    })
+
+STEPS = ("/start", "select_", "contract", "start_trending", "trend_", "payment_paid", "activate_")
+
+async def run_user(mocks, user_id, timings):
+    address = token_address(user_id % args.tokens + 1)
+    updates = [
+        ("/start", lambda: message_update(user_id, "/start")),
+        ("select_", lambda: callback_update(user_id, "select_ethereum")),
+        ("contract", lambda: message_update(user_id, address)),
+        ("start_trending", lambda: callback_update(user_id, "start_trending")),
+        ("trend_", lambda: callback_update(user_id, "trend_3h")),
+        ("payment_paid", lambda: callback_update(user_id, "payment_paid")),
+    ]
+    # process_updates, like polling, runs each update in its own task and context
+    flow_started = time.perf_counter()
+    for step, build in updates:
+        started = time.perf_counter()
+        await main.dp.process_updates([build()])
+        timings[step].append(time.perf_counter() - started)
+    callback, support_message = mocks.activations.pop(user_id)
+    started = time.perf_counter()
+    await main.dp.process_updates([callback_update(SUPPORT_USER, callback, support_message)])
+    timings["activate_"].append(time.perf_counter() - started)
+    timings["flow"].append(time.perf_counter() - flow_started)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def report_line(name, values):
+    return (f"{name:<16} n={len(values):<6} p50={percentile(values, 0.5) * 1000:8.1f}ms  "
+            f"p99={percentile(values, 0.99) * 1000:8.1f}ms  max={max(values, default=0) * 1000:8.1f}ms")
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def load_test(mocks):
+    timings = {step: [] for step in (*STEPS, "flow")}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id):
+        async with semaphore:
+            await run_user(mocks, user_id, timings)
+
+    rss_before = max_rss_mb()
+    started = time.perf_counter()
+    results = await asyncio.gather(*(limited(1000 + i) for i in range(args.users)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    failures = [r for r in results if isinstance(r, Exception)]
+
+    print(f"\n📊 Full flow: {args.users} users, concurrency {args.concurrency}, "
+          f"DexScreener {args.api_latency:g}ms, Telegram {args.telegram_latency:g}ms")
+    print(f"Throughput: {len(timings['flow']) / elapsed:.1f} flows/s, "
+          f"{sum(len(timings[s]) for s in STEPS) / elapsed:.1f} updates/s over {elapsed:.2f}s")
+    if failures:
+        print(f"❌ {len(failures)} flows failed, first: {failures[0]!r}")
+    for step in (*STEPS, "flow"):
+        print(report_line(step, timings[step]))
+    print(f"Max RSS: {max_rss_mb():.1f} MB (was {rss_before:.1f} MB before the run)")
+    print(f"Telegram calls: {dict(sorted(mocks.calls.items()))}")
+    print(f"Outbox: {main.outbox.stats()}")
+
+# ---------------- Microbenchmarks ----------------
+def bench(name, fn, number):
+    fn()
+    started = time.perf_counter()
+    for _ in range(number):
+        fn()
+    per_call = (time.perf_counter() - started) / number
+    print(f"{name:<34} {per_call * 1e6:10.1f} µs/call  ({number} calls)")
+
+async def abench(name, fn, number):
+    await fn(0)
+    samples = []
+    for i in range(1, number + 1):
+        started = time.perf_counter()
+        await fn(i)
+        samples.append(time.perf_counter() - started)
+    print(f"{name:<34} {statistics.mean(samples) * 1e6:10.1f} µs/call  "
+          f"(p50 {percentile(samples, 0.5) * 1e6:.0f}, p99 {percentile(samples, 0.99) * 1e6:.0f}, {number} calls)")
+
+async def microbenchmarks(mocks):
+    print("\n⏱️ Microbenchmarks")
+    raw = make_pair(token_address(1), "ethereum", 250_000)
+    body = json.dumps({"pairs": [raw] * 30}).encode()
+    pair = main.PairSnapshot.from_dexscreener(raw)
+    bench("parse 30-pair response", lambda: [main.PairSnapshot.from_dexscreener(p) for p in main.json_loads(body)["pairs"]], 2000)
+    bench("create_professional_message", lambda: main.create_professional_message(pair, "ethereum"), 20000)
+    bench("format_number", lambda: main.format_number(1234567.891), 200000)
+    bench("_process_logo (decode+encode)", lambda: main._process_logo(mocks.logo, (300, 300)), 50)
+    # A fresh URL each call: download and URL lookup are paid, the content-addressed PNG is reused
+    await abench("resize_image (new URL, same logo)", lambda i: main.resize_image(f"{MOCK_URL}/logo/0.png?v={i}"), 200)
+    # Uncached: an empty logo cache every call, so decode and encode run through the image pool too
+    await abench("resize_image (uncached)", uncached_resize, 50)
+
+async def uncached_resize(i):
+    main.logo_cache = main.LogoCache(main.LOGO_CACHE_MAX_BYTES)
+    return await main.resize_image(f"{MOCK_URL}/logo/0.png")
+
+# ---------------- Run ----------------
+async def run():
+    mocks = MockServices()
+    runner = web.AppRunner(mocks.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    await main.on_startup(main.dp)
+    try:
+        if not args.micro_only:
+            await load_test(mocks)
+        await microbenchmarks(mocks)
+    finally:
+        await main.on_shutdown(main.dp)
+        session = await main.bot.get_session()
+        await session.close()
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run()))
@@ -1,14 +1,42 @@
 import os
+import re
+import sys
+import json
+import time
+import copy
+import hmac
+import queue
+import signal
+import sqlite3
+import hashlib
 import aiohttp
+import numpy as np
+import math
+import heapq
+import bisect
+import random
 import asyncio
+import threading
+import multiprocessing
+from aiohttp import web
+from datetime import datetime, timezone
+from dataclasses import dataclass, astuple
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse
 from io import BytesIO
 from PIL import Image
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.utils import executor
+from aiogram.utils.markdown import quote_html
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.utils.exceptions import TelegramAPIError, MessageNotModified, MessageToEditNotFound, RetryAfter
 
 # ---------------- Load Bot Token ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -18,6 +46,8 @@ if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN environment variable not found!")
 
 # ---------------- Payment Wallets ----------------
+# The tables below are the built-in network config. A CONFIG_PATH file replaces them at
+# startup and whenever it changes (see Network Config), so always read them at use time.
 PAYMENT_WALLETS = {
     "solana": "BUBMVmvrUVGmN29jFiKEJopjdKFPifSew3cDT1CB5Xah",
     "ethereum": "0xbc0F786476d68dfC99FCd20D58F887b97fEa7204",
@@ -35,6 +65,9 @@ TRENDING_PACKAGES = {
     "arbitrum": {"3h": 0.0593, "12h": 0.2223, "24h": 0.4447}
 }
 
+# ---------------- Package Durations ----------------
+PACKAGE_DURATIONS = {"3h": 3 * 3600, "12h": 12 * 3600, "24h": 24 * 3600}  # seconds
+
 # ---------------- Chain ID mapping ----------------
 CHAIN_IDS = {
     "solana": "solana",
@@ -44,161 +77,3210 @@ CHAIN_IDS = {
     "arbitrum": "arbitrum"
 }
 
-# ---------------- Network Emojis ----------------
-NETWORK_EMOJIS = {
-    "solana": "💜",
-    "ethereum": "💠",
-    "bsc": "🟡",
-    "base": "🧊",
-    "arbitrum": "⚪"
-}
+# ---------------- Network Emojis ----------------
+NETWORK_EMOJIS = {
+    "solana": "💜",
+    "ethereum": "💠",
+    "bsc": "🟡",
+    "base": "🧊",
+    "arbitrum": "⚪"
+}
+
+# ---------------- Network Labels ----------------
+NETWORK_LABELS = {
+    "solana": "Solana",
+    "ethereum": "Ethereum",
+    "bsc": "BSC",
+    "base": "Base",
+    "arbitrum": "Arbitrum"
+}
+
+# ---------------- Config Settings ----------------
+CONFIG_PATH = os.getenv("CONFIG_PATH")                                 # JSON network config, reloaded on change
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", "5"))   # seconds between checks of CONFIG_PATH
+
+# ---------------- Payment Watcher Settings ----------------
+# JSON-RPC endpoint per network, e.g. PAYMENT_RPC_ETHEREUM=http://127.0.0.1:8545 (anvil) or
+# PAYMENT_RPC_SOLANA=http://127.0.0.1:8899 (solana-test-validator). Networks without one
+# keep the manual TX ID flow. Only networks in PAYMENT_WALLETS are picked up.
+PAYMENT_RPC_URLS = {
+    network: os.environ[f"PAYMENT_RPC_{network.upper()}"]
+    for network in PAYMENT_WALLETS if os.getenv(f"PAYMENT_RPC_{network.upper()}")
+}
+PAYMENT_POLL_INTERVAL = float(os.getenv("PAYMENT_POLL_INTERVAL", "15"))   # seconds between RPC polls
+PAYMENT_ORDER_TTL = float(os.getenv("PAYMENT_ORDER_TTL", str(2 * 3600)))  # seconds an order can still be paid
+PAYMENT_CONFIRMATIONS = int(os.getenv("PAYMENT_CONFIRMATIONS", "3"))      # EVM blocks behind head before scanning
+PAYMENT_MAX_BLOCKS = int(os.getenv("PAYMENT_MAX_BLOCKS", "500"))          # EVM blocks scanned per poll
+PAYMENT_BATCH_SIZE = int(os.getenv("PAYMENT_BATCH_SIZE", "50"))           # calls per JSON-RPC batch request
+PAYMENT_AMOUNT_STEP = 0.000001                                            # unit used to make order amounts unique
+NATIVE_DECIMALS = {"solana": 9}                                           # everything else is an 18-decimal EVM coin
+
+# ---------------- Network Config ----------------
+# Config file format (JSON), networks listed in menu order:
+# {"networks": {"solana": {"chain_id": "solana", "emoji": "💜", "label": "Solana",
+#                          "wallet": "...", "packages": {"3h": 1.2, "12h": 4.5, "24h": 9}}, ...}}
+NETWORK_NAME = re.compile(r"[a-z0-9]+")  # callback data is split on "_", so names can't contain it
+
+def parse_network_config(data):
+    # Validates a config document and returns the tables it defines; raises ValueError
+    networks = data.get("networks") if isinstance(data, dict) else None
+    if not isinstance(networks, dict) or not networks:
+        raise ValueError('config needs a non-empty "networks" object')
+    tables = {"wallets": {}, "packages": {}, "chain_ids": {}, "emojis": {}, "labels": {}}
+    for network, entry in networks.items():
+        if not NETWORK_NAME.fullmatch(network):
+            raise ValueError(f"network name {network!r} must be lowercase letters and digits")
+        if not isinstance(entry, dict):
+            raise ValueError(f"{network}: expected an object")
+        wallet = entry.get("wallet")
+        if not isinstance(wallet, str) or not wallet.strip():
+            raise ValueError(f"{network}: wallet is required")
+        packages = entry.get("packages")
+        if not isinstance(packages, dict) or set(packages) != set(PACKAGE_DURATIONS):
+            raise ValueError(f"{network}: packages must define exactly {', '.join(PACKAGE_DURATIONS)}")
+        for package, price in packages.items():
+            if isinstance(price, bool) or not isinstance(price, (int, float)) or price <= 0:
+                raise ValueError(f"{network}: price for {package} must be a positive number")
+        for field in ("chain_id", "emoji", "label"):
+            if field in entry and (not isinstance(entry[field], str) or not entry[field]):
+                raise ValueError(f"{network}: {field} must be a non-empty string")
+        tables["wallets"][network] = wallet.strip()
+        tables["packages"][network] = dict(packages)
+        tables["chain_ids"][network] = entry.get("chain_id", network)
+        tables["emojis"][network] = entry.get("emoji", "🔗")
+        tables["labels"][network] = entry.get("label", network.title())
+    return tables
+
+def apply_network_config(tables):
+    # Plain name rebinding with no await in between, so handlers see either the old
+    # tables or the new ones, never a mix
+    global PAYMENT_WALLETS, TRENDING_PACKAGES, CHAIN_IDS, NETWORK_EMOJIS, NETWORK_LABELS
+    PAYMENT_WALLETS = tables["wallets"]
+    TRENDING_PACKAGES = tables["packages"]
+    CHAIN_IDS = tables["chain_ids"]
+    NETWORK_EMOJIS = tables["emojis"]
+    NETWORK_LABELS = tables["labels"]
+
+def read_config_file(path):
+    with open(path, "rb") as f:
+        return parse_network_config(json.loads(f.read()))
+
+if CONFIG_PATH and os.path.exists(CONFIG_PATH):
+    try:
+        apply_network_config(read_config_file(CONFIG_PATH))
+    except (OSError, ValueError) as e:
+        raise ValueError(f"❌ Invalid network config in {CONFIG_PATH}: {e}")
+
+# ---------------- HTTP Client Settings ----------------
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))                  # total seconds per request
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))               # max open connections overall
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "20"))        # max open connections per host
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))              # seconds an idle connection is kept
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))                   # seconds a DNS answer is cached
+
+# ---------------- Shard Settings ----------------
+SHARDS = int(os.getenv("SHARDS", "1"))                                 # worker processes; more than 1 starts the sharded launcher
+SHARD_ID = int(os.getenv("SHARD_ID", "-1"))                            # set by the launcher; -1 is the front (or only) process
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))          # updates buffered per worker before backpressure
+IS_LEADER = SHARD_ID <= 0                                              # the only process, or shard 0, runs background services
+
+# ---------------- Cache Settings ----------------
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "30"))            # seconds a token lookup stays fresh
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "2048"))          # max cached (chain, token) entries
+LOGO_CACHE_MAX_BYTES = int(os.getenv("LOGO_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # in-memory PNG budget
+LOGO_CACHE_DIR = os.getenv("LOGO_CACHE_DIR") or ("logo_cache" if SHARDS > 1 else None)  # on-disk tier, shared by shards
+LOGO_URL_TTL = float(os.getenv("LOGO_URL_TTL", str(6 * 3600)))        # seconds before a logo URL is downloaded again
+LOGO_CACHE_DIR_MAX_BYTES = int(os.getenv("LOGO_CACHE_DIR_MAX_BYTES", str(256 * 1024 * 1024)))  # on-disk tier budget
+
+# ---------------- Image Processing Settings ----------------
+IMAGE_POOL = os.getenv("IMAGE_POOL", "thread").lower()                 # "thread" or "process"
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", "2"))
+IMAGE_MAX_JOBS = int(os.getenv("IMAGE_MAX_JOBS", "4"))                 # concurrent decode/encode jobs
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(5 * 1024 * 1024)))  # largest logo download accepted
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(4096 * 4096)))    # largest logo decoded
+
+# ---------------- DexScreener Settings ----------------
+DEXSCREENER_API_URL = os.getenv("DEXSCREENER_API_URL", "https://api.dexscreener.com").rstrip("/")
+DEXSCREENER_BATCH_SIZE = 30                                            # API limit for comma-separated tokens
+MAX_CAS_PER_MESSAGE = int(os.getenv("MAX_CAS_PER_MESSAGE", "30"))      # multi-CA mode cap per message
+
+# ---------------- Market Data Provider Settings ----------------
+MARKET_PROVIDERS = [p.strip() for p in os.getenv("MARKET_PROVIDERS", "dexscreener,geckoterminal").split(",") if p.strip()]
+GECKOTERMINAL_API_URL = os.getenv("GECKOTERMINAL_API_URL", "https://api.geckoterminal.com/api/v2").rstrip("/")
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "1.0"))                   # hedge delay until enough latencies are known
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.2"))           # clamp for the p95-based hedge delay
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "3.0"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))             # consecutive failures that open a provider's circuit
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))          # seconds an open circuit skips the provider
+
+# ---------------- Market Refresh Settings ----------------
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", "30"))          # seconds between refreshes of tracked tokens
+REFRESH_JITTER = float(os.getenv("REFRESH_JITTER", "0.2"))             # +/- fraction of the interval
+REFRESH_MAX_BACKOFF = float(os.getenv("REFRESH_MAX_BACKOFF", "300"))   # longest pause after rate limiting
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", "2"))       # batch requests in flight per refresh
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "120"))         # seconds a refreshed snapshot is served
+
+# ---------------- Alert Settings ----------------
+ALERT_MAX_PER_USER = int(os.getenv("ALERT_MAX_PER_USER", "20"))        # active alert subscriptions per user
+ALERT_RATE_PER_HOUR = float(os.getenv("ALERT_RATE_PER_HOUR", "12"))    # alerts delivered per user per hour
+ALERT_BURST = int(os.getenv("ALERT_BURST", "4"))                       # alerts a user can get back to back
+
+# ---------------- Outbound Queue Settings ----------------
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))          # Telegram calls per second across all chats
+if SHARD_ID >= 0:
+    SEND_GLOBAL_RATE /= SHARDS                                         # each shard gets an equal slice of the bot's budget
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))               # per private chat, per second
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))    # per group/channel, per second
+SEND_BURST = int(os.getenv("SEND_BURST", "3"))                         # calls a chat may make back to back
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "16"))            # Telegram calls in flight
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))             # retries after a 429 before giving up
+
+# ---------------- Storage Settings ----------------
+DB_PATH = os.getenv("DB_PATH", "omnitrending.db")                      # SQLite database (WAL mode)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()               # "sqlite", "redis" or "memory"
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))                    # seconds before an idle session expires
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))       # seconds between batched FSM writes
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0")
+
+# ---------------- Ledger Settings ----------------
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "1"))  # seconds between batched ledger writes
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "200"))          # buffered events that trigger an early write
+LEDGER_QUERY_LIMIT = int(os.getenv("LEDGER_QUERY_LIMIT", "30"))         # events listed by /orders
+
+# ---------------- Run Mode Settings ----------------
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")                       # self-hosted Bot API server or a mock
+RUN_MODE = os.getenv("RUN_MODE", "polling").lower()                    # "polling" (development) or "webhook"
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")                               # public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", os.getenv("WEBAPP_PORT", "8080")))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))              # updates processed concurrently
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))      # updates buffered before answering 503
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))  # seconds to finish queued updates on shutdown
+
+# ---------------- Leaderboard Settings ----------------
+LEADERBOARD_CHAT = os.getenv("LEADERBOARD_CHAT")                       # channel where the ranking is pinned
+LEADERBOARD_INTERVAL = float(os.getenv("LEADERBOARD_INTERVAL", "60"))  # seconds between pinned-message edits
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))            # tokens shown per network
+
+# ---------------- Inline Mode Settings ----------------
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.6"))          # seconds a query must stay unchanged before lookup
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))          # seconds Telegram may cache inline results
+
+# ---------------- Metrics Settings ----------------
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))                 # 0 disables the /metrics endpoint
+if SHARD_ID >= 0 and METRICS_PORT:
+    METRICS_PORT += SHARD_ID + 1                                       # shard N serves metrics on METRICS_PORT + N + 1
+PROFILER_HZ = float(os.getenv("PROFILER_HZ", "0"))                     # >0 samples the event loop from startup
+
+# ---------------- Database ----------------
+# A single SQLite connection owned by a single worker thread: every query runs through
+# run_db() so blocking I/O never touches the event loop and writes are serialised.
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_db_conn = None
+
+def get_db():
+    global _db_conn
+    if _db_conn is None:
+        _db_conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _db_conn.execute("PRAGMA journal_mode=WAL")
+        _db_conn.execute("PRAGMA synchronous=NORMAL")
+        _db_conn.execute("PRAGMA busy_timeout=5000")
+    return _db_conn
+
+async def run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, fn, *args)
+
+def fetch_dicts(sql, params=()):
+    cursor = get_db().execute(sql, params)
+    columns = [c[0] for c in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+def _init_kv():
+    db = get_db()
+    with db:
+        db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+def kv_get(key, default=None):
+    _init_kv()
+    row = get_db().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def kv_set(key, value):
+    _init_kv()
+    db = get_db()
+    with db:
+        db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?)", (key, str(value)))
+
+def close_db():
+    global _db_conn
+    if _db_conn is not None:
+        _db_conn.close()
+        _db_conn = None
+
+# ---------------- FSM Storage ----------------
+class SQLiteStorage(BaseStorage):
+    # Persistent FSM storage. Every live session (in sharded mode, only this shard's users)
+    # is loaded into memory on startup and served from there; changed sessions are written
+    # back in one transaction every flush_interval seconds. Sessions not written for `ttl`
+    # seconds expire.
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.data = {}       # (chat, user) -> {'state', 'data', 'bucket', 'touched'}
+        self._dirty = set()
+        self._flush_task = None
+        self._last_sweep = time.time()
+        self._load()
+
+    def _load(self):
+        db = get_db()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS fsm_sessions ("
+                " chat TEXT NOT NULL, user TEXT NOT NULL, state TEXT, data TEXT NOT NULL,"
+                " bucket TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (chat, user))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS fsm_sessions_updated ON fsm_sessions (updated_at)")
+            db.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+        for chat, user, state, data, bucket, updated_at in db.execute("SELECT * FROM fsm_sessions"):
+            if SHARD_ID >= 0 and session_shard(chat, user, SHARDS) != SHARD_ID:
+                continue  # another shard's user
+            self.data[(chat, user)] = {
+                'state': state, 'data': json.loads(data), 'bucket': json.loads(bucket), 'touched': updated_at,
+            }
+        print(f"💾 Restored {len(self.data)} FSM sessions from {DB_PATH}")
+
+    def _entry(self, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        entry = self.data.get((chat, user))
+        if entry is None or entry['touched'] < time.time() - self.ttl:
+            entry = {'state': None, 'data': {}, 'bucket': {}, 'touched': time.time()}
+        return (chat, user), entry
+
+    def _save(self, key, entry):
+        entry['touched'] = time.time()
+        if entry['state'] is None and not entry['data'] and not entry['bucket']:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = entry
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        now = time.time()
+        upserts, deletes = [], []
+        for key in self._dirty:
+            entry = self.data.get(key)
+            if entry is None:
+                deletes.append(key)
+            else:
+                upserts.append((*key, entry['state'], json.dumps(entry['data']), json.dumps(entry['bucket']), entry['touched']))
+        self._dirty.clear()
+        expired_before = None
+        if now - self._last_sweep >= self.SWEEP_INTERVAL:
+            self._last_sweep = now
+            expired_before = now - self.ttl
+            for key in [k for k, e in self.data.items() if e['touched'] < expired_before]:
+                del self.data[key]
+        if upserts or deletes or expired_before:
+            try:
+                await run_db(self._write, upserts, deletes, expired_before)
+            except Exception as e:
+                print(f"Error flushing FSM sessions: {e}")
+
+    @staticmethod
+    def _write(upserts, deletes, expired_before):
+        db = get_db()
+        with db:
+            if upserts:
+                db.executemany("INSERT OR REPLACE INTO fsm_sessions VALUES (?, ?, ?, ?, ?, ?)", upserts)
+            if deletes:
+                db.executemany("DELETE FROM fsm_sessions WHERE chat = ? AND user = ?", deletes)
+            if expired_before:
+                db.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (expired_before,))
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, entry = self._entry(chat, user)
+        return entry['state'] if entry['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, entry = self._entry(chat, user)
+        return copy.deepcopy(entry['data'])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, entry = self._entry(chat, user)
+        entry['state'] = self.resolve_state(state)
+        self._save(key, entry)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, entry = self._entry(chat, user)
+        entry['data'] = copy.deepcopy(data or {})
+        self._save(key, entry)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, entry = self._entry(chat, user)
+        entry['data'].update(data or {}, **kwargs)
+        self._save(key, entry)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key, entry = self._entry(chat, user)
+        entry['state'] = None
+        if with_data:
+            entry['data'] = {}
+        self._save(key, entry)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, entry = self._entry(chat, user)
+        return copy.deepcopy(entry['bucket'])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, entry = self._entry(chat, user)
+        entry['bucket'] = copy.deepcopy(bucket or {})
+        self._save(key, entry)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, entry = self._entry(chat, user)
+        entry['bucket'].update(bucket or {}, **kwargs)
+        self._save(key, entry)
+
+def create_storage():
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "redis":
+        # Network store for running several bot processes; aiogram's RedisStorage2 uses redis.asyncio
+        try:
+            import redis.asyncio  # noqa: F401
+        except ImportError:
+            raise ValueError("❌ FSM_STORAGE=redis requires the redis package (pip install redis)")
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        url = urlparse(FSM_REDIS_URL)
+        return RedisStorage2(
+            host=url.hostname or "localhost", port=url.port or 6379, db=int(url.path.lstrip("/") or 0),
+            password=url.password, ssl=url.scheme == "rediss", prefix="omnitrending_fsm",
+            state_ttl=FSM_TTL, data_ttl=FSM_TTL, bucket_ttl=FSM_TTL,
+        )
+    return SQLiteStorage()
+
+# ---------------- Metrics ----------------
+# Minimal Prometheus text-format registry; scraped from METRICS_HOST:METRICS_PORT/metrics.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"'.replace("\n", " ") for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), fn=None):
+        super().__init__(name, help_text, labels)
+        self.fn = fn  # read at scrape time instead of being updated
+
+    def dec(self, *label_values):
+        self.inc(*label_values, amount=-1)
+
+    def samples(self):
+        if self.fn is not None:
+            yield f"{self.name} {self.fn()}"
+        else:
+            yield from super().samples()
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.buckets = buckets
+        self.values = {}  # label values -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *label_values):
+        return HistogramTimer(self, label_values)
+
+    def samples(self):
+        for label_values, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                labels = format_labels((*self.labels, "le"), (*label_values, bound))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {series[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+class HistogramTimer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+FETCH_TOKEN_SECONDS = metrics.register(Histogram(
+    "omnitrending_fetch_token_info_seconds", "fetch_token_info latency, cache hits included"))
+PROVIDER_SECONDS = metrics.register(Histogram(
+    "omnitrending_provider_request_seconds", "Market data provider request latency", ("provider",)))
+LOGO_SECONDS = metrics.register(Histogram(
+    "omnitrending_logo_seconds", "Logo pipeline stage latency", ("stage",)))
+HANDLER_SECONDS = metrics.register(Histogram(
+    "omnitrending_handler_seconds", "Update handling latency, end to end", ("handler",)))
+TELEGRAM_SECONDS = metrics.register(Histogram(
+    "omnitrending_telegram_api_seconds", "Telegram Bot API call latency", ("method",)))
+ERRORS = metrics.register(Counter(
+    "omnitrending_errors_total", "Errors by where they happened and exception type", ("source", "type")))
+IN_FLIGHT = metrics.register(Gauge(
+    "omnitrending_in_flight", "Requests currently in flight", ("kind",)))
+
+# Callback data prefixes that get their own handler latency series; everything else is "other"
+HANDLER_LABELS = ("select_", "trend_", "payment_paid", "activate_", "start_trending", "main_menu", "show_prices", "support", "alert")
+
+def callback_label(data):
+    return next((prefix for prefix in HANDLER_LABELS if (data or "").startswith(prefix)), "other")
+
+class MetricsMiddleware(BaseMiddleware):
+    # Times every update from the first handler check to the end of the matched handler
+    def _start(self, data):
+        data["_metrics_started"] = time.perf_counter()
+        IN_FLIGHT.inc("handler")
+
+    def _finish(self, data, label):
+        HANDLER_SECONDS.observe(time.perf_counter() - data["_metrics_started"], label)
+        IN_FLIGHT.dec("handler")
+
+    async def on_pre_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        command = message.get_command(pure=True) if message.is_command() else None
+        self._finish(data, f"/{command}" if command in ("start", "help", "stats", "campaigns", "extend", "cancel", "alerts", "orders", "revenue") else "message")
+
+    async def on_pre_process_callback_query(self, callback_query, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finish(data, callback_label(callback_query.data))
+
+    async def on_pre_process_inline_query(self, inline_query, data):
+        self._start(data)
+
+    async def on_post_process_inline_query(self, inline_query, results, data):
+        self._finish(data, "inline")
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        # Long polls would swamp the latency histogram, so getUpdates isn't measured
+        if method == "getUpdates":
+            return await super().request(method, data, files, **kwargs)
+        IN_FLIGHT.inc("telegram")
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            ERRORS.inc("telegram", type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - start, method)
+            IN_FLIGHT.dec("telegram")
+
+class SamplingProfiler:
+    # Samples the event loop thread's stack from a background thread and aggregates the
+    # stacks in collapsed format ("outer;inner;leaf count"), ready for flamegraph.pl or
+    # speedscope. Cheap enough to leave running at a low rate in production.
+    def __init__(self):
+        self.stacks = {}
+        self.samples = 0
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, hz, duration=None):
+        if self.running:
+            return
+        self._target = threading.get_ident()  # called from the event loop thread
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(1 / hz, duration), daemon=True, name="profiler")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval, duration):
+        deadline = time.monotonic() + duration if duration else None
+        while not self._stop.wait(interval):
+            if deadline and time.monotonic() >= deadline:
+                break
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items(), key=lambda x: -x[1]))
+
+    def reset(self):
+        self.stacks = {}
+        self.samples = 0
+
+profiler = SamplingProfiler()
+
+async def handle_metrics(request: web.Request):
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def handle_profile(request: web.Request):
+    # GET /debug/profile               -> stacks collected so far
+    # GET /debug/profile?seconds=30    -> sample for 30s (at PROFILER_HZ, or 100 Hz) and return them
+    # GET /debug/profile?reset=1       -> clear collected stacks
+    if request.query.get("reset"):
+        profiler.reset()
+    seconds = float(request.query.get("seconds", 0) or 0)
+    if seconds > 0 and not profiler.running:
+        profiler.reset()
+        profiler.start(PROFILER_HZ or 100, duration=seconds)
+        await asyncio.sleep(seconds)
+        profiler.stop()
+    return web.Response(text=profiler.collapsed() or "no samples\n")
+
+metrics_runner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    if PROFILER_HZ > 0:
+        profiler.start(PROFILER_HZ)
+    if METRICS_PORT <= 0:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/debug/profile", handle_profile)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    try:
+        await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+        print(f"📊 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"⚠️ Metrics endpoint disabled: {e}")
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+async def stop_metrics_server():
+    global metrics_runner
+    profiler.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# ---------------- Initialize Bot ----------------
+telegram_server = TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION
+bot = InstrumentedBot(token=BOT_TOKEN, parse_mode=types.ParseMode.HTML, server=telegram_server)
+dp = Dispatcher(bot)  # FSM storage is created in on_startup, in the process that serves updates
+dp.middleware.setup(MetricsMiddleware())
+
+@dp.errors_handler()
+async def count_handler_error(update, exception):
+    # Only counts; returning None lets aiogram log the error as before
+    ERRORS.inc("handler", type(exception).__name__)
+
+# ---------------- States ----------------
+class UserState(StatesGroup):
+    waiting_for_ca = State()
+    waiting_for_trend_package = State()
+    waiting_for_payment = State()
+    trending_active = State()
+    waiting_for_alert_metric = State()
+    waiting_for_alert_threshold = State()
+
+# ---------------- Outbound Queue ----------------
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def delay(self):
+        # Seconds until a token is available (0 if one is available now)
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.delay()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def full(self):
+        self.delay()
+        return self.tokens >= self.burst
+
+def drop_full_buckets(buckets, keep=()):
+    # A full bucket behaves exactly like a new one, so idle keys can go and be recreated on demand
+    for key in [key for key, bucket in buckets.items() if key not in keep and bucket.full()]:
+        del buckets[key]
+
+class Outbox:
+    # Every chat-bound Telegram call goes through here. Calls for one chat run strictly in
+    # order, spaced by a per-chat token bucket (SEND_CHAT_RATE for users, SEND_GROUP_RATE
+    # for groups and channels) and a global bucket (SEND_GLOBAL_RATE). The dispatcher always
+    # serves the chat that becomes eligible first, so one slow chat never blocks the rest.
+    # A RetryAfter pauses the chat (or everything, for global flood waits) for the time
+    # Telegram asks and retries. Edits of a message that are still queued are coalesced into
+    # the newest one.
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self._buckets = {}      # chat_id -> TokenBucket, dropped once full and idle
+        self._last_sweep = time.monotonic()
+        self._queues = {}       # chat_id -> deque of jobs
+        self._busy = set()      # chats with a call in flight or on the ready heap
+        self._ready = []        # (eligible_at, seq, chat_id)
+        self._edits = {}        # (chat_id, message_id) -> queued edit job
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._inflight = asyncio.Semaphore(SEND_CONCURRENCY)
+        self._task = None
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            is_group = str(chat_id).startswith("-") or str(chat_id).startswith("@")
+            bucket = TokenBucket(SEND_GROUP_RATE if is_group else SEND_CHAT_RATE, SEND_BURST)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule(self, chat_id):
+        self._seq += 1
+        eligible_at = time.monotonic() + self._bucket(chat_id).delay()
+        heapq.heappush(self._ready, (eligible_at, self._seq, chat_id))
+        self._wakeup.set()
+
+    async def call(self, chat_id, method, *args, coalesce_key=None, **kwargs):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if coalesce_key is not None and coalesce_key in self._edits:
+            job = self._edits[coalesce_key]
+            job['args'], job['kwargs'] = args, kwargs
+            self.coalesced += 1
+            return await asyncio.shield(job['future'])
+        job = {
+            'method': method, 'args': args, 'kwargs': kwargs, 'coalesce_key': coalesce_key,
+            'future': asyncio.get_running_loop().create_future(), 'enqueued': time.monotonic(), 'attempts': 0,
+        }
+        if coalesce_key is not None:
+            self._edits[coalesce_key] = job
+        self._queues.setdefault(chat_id, deque()).append(job)
+        self.depth += 1
+        if chat_id not in self._busy:
+            self._busy.add(chat_id)
+            self._schedule(chat_id)
+        return await asyncio.shield(job['future'])
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._ready[0][0] - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                timer = asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    timer.cancel()
+                continue
+            global_delay = self.global_bucket.delay()
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+            if time.monotonic() - self._last_sweep >= self.SWEEP_INTERVAL:
+                self._last_sweep = time.monotonic()
+                drop_full_buckets(self._buckets, keep=self._busy)
+            _, _, chat_id = heapq.heappop(self._ready)
+            bucket = self._bucket(chat_id)
+            if bucket.delay() > 0:
+                self._schedule(chat_id)
+                continue
+            bucket.consume()
+            self.global_bucket.consume()
+            await self._inflight.acquire()
+            asyncio.create_task(self._send(chat_id))
+
+    async def _send(self, chat_id):
+        queue = self._queues[chat_id]
+        job = queue[0]
+        if job['coalesce_key'] is not None:
+            self._edits.pop(job['coalesce_key'], None)
+        done = True
+        try:
+            job['attempts'] += 1
+            for value in (*job['args'], *job['kwargs'].values()):
+                if isinstance(value, BytesIO):
+                    value.seek(0)
+            result = await getattr(bot, job['method'])(*job['args'], **job['kwargs'])
+            job['future'].set_result(result)
+            self.sent += 1
+        except RetryAfter as e:
+            if job['attempts'] <= SEND_MAX_RETRIES:
+                self.retried += 1
+                done = False
+                self._bucket(chat_id).pause(e.timeout)
+                if job['attempts'] > 1:
+                    # Repeated flood waits usually mean the bot-wide limit, not this chat
+                    self.global_bucket.pause(e.timeout)
+                print(f"⚠️ Telegram flood wait {e.timeout}s for chat {chat_id}")
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            self._inflight.release()
+            if done:
+                queue.popleft()
+                self.depth -= 1
+                self._record_latency(time.monotonic() - job['enqueued'])
+            if queue:
+                self._schedule(chat_id)
+            else:
+                del self._queues[chat_id]
+                self._busy.discard(chat_id)
+
+    def _fail(self, job, error):
+        self.failed += 1
+        job['future'].set_exception(error)
+        job['future'].exception()  # callers that don't await still leave no warning behind
+
+    def _record_latency(self, latency):
+        self.latency_avg = latency if not self.sent else 0.9 * self.latency_avg + 0.1 * latency
+        self.latency_max = max(self.latency_max, latency)
+
+    async def drain(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "chats": len(self._queues),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "latency_avg": self.latency_avg,
+            "latency_max": self.latency_max,
+        }
+
+    # Bot API wrappers
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call(chat_id, "send_message", chat_id, text, **kwargs)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self.call(chat_id, "send_photo", chat_id, photo, **kwargs)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return await self.call(chat_id, "edit_message_text", text, chat_id, message_id,
+                               coalesce_key=(chat_id, message_id), **kwargs)
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.call(chat_id, "delete_message", chat_id, message_id)
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        return await self.call(chat_id, "pin_chat_message", chat_id, message_id, **kwargs)
+
+    # types.Message shortcuts
+    async def answer(self, message: types.Message, text, **kwargs):
+        return await self.send_message(message.chat.id, text, **kwargs)
+
+    async def answer_photo(self, message: types.Message, photo, **kwargs):
+        return await self.send_photo(message.chat.id, photo, **kwargs)
+
+    async def edit(self, message: types.Message, text, **kwargs):
+        return await self.edit_message_text(text, message.chat.id, message.message_id, **kwargs)
+
+    async def delete(self, message: types.Message):
+        return await self.delete_message(message.chat.id, message.message_id)
+
+outbox = Outbox()
+metrics.register(Gauge("omnitrending_outbox_depth", "Telegram calls waiting in the send queue", fn=lambda: outbox.depth))
+
+# ---------------- HTTP Client ----------------
+# One long-lived, pooled session shared by every outbound call (DexScreener, logo hosts).
+# Created in on_startup and closed in on_shutdown so connections, TLS sessions and DNS
+# answers are reused across requests instead of being rebuilt per lookup.
+http_session = None
+
+def create_http_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_TTL,
+    )
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                 headers={"User-Agent": "OmniTrendingBot/1.0"})
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# ---------------- TTL Cache ----------------
+class TTLCache:
+    # Bounded LRU cache with per-entry expiry. Concurrent misses for the same key
+    # share one in-flight load ("single-flight") instead of each hitting the API.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}         # key -> Task of the running load
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    async def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # The load runs in its own task, so cancelling any caller (including the one
+            # that started it) never cancels the result the others are waiting on
+            task = asyncio.ensure_future(loader())
+            self.track(key, task)
+        return await asyncio.shield(task)
+
+    def pending(self, key):
+        return self._inflight.get(key)
+
+    def track(self, key, task):
+        # Registers a load started elsewhere (a batch) so get_or_load callers share it
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._load_done(key, t))
+
+    def _load_done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            self.set(key, task.result())
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+def normalize_address(token_address):
+    # EVM addresses are case-insensitive, Solana (base58) addresses are not
+    address = (token_address or "").strip()
+    if address.startswith("0x"):
+        address = address.lower()
+    return address
+
+def token_cache_key(chain_id, token_address):
+    return (chain_id.lower(), normalize_address(token_address))
+
+class SharedTokenCache:
+    # SQLite tier behind token_cache for the sharded mode: a lookup on one shard, or a pass
+    # of the leader's market refresher, serves every other shard until the entry expires.
+    # Pairs are stored as JSON arrays of PairSnapshot fields.
+    SWEEP_INTERVAL = 300
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._ready = False
+        self._last_sweep = 0.0
+
+    def _init_db(self):
+        if not self._ready:
+            db = get_db()
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS token_cache ("
+                    " chain_id TEXT NOT NULL, token TEXT NOT NULL, expires_at REAL NOT NULL, data TEXT NOT NULL,"
+                    " PRIMARY KEY (chain_id, token)) WITHOUT ROWID"
+                )
+            self._ready = True
+
+    def _get_many(self, keys):
+        self._init_db()
+        now = time.time()
+        rows = {}
+        for key in keys:
+            row = get_db().execute(
+                "SELECT data FROM token_cache WHERE chain_id = ? AND token = ? AND expires_at > ?", (*key, now)
+            ).fetchone()
+            if row:
+                rows[key] = row[0]
+        return rows
+
+    def _put_many(self, rows):
+        self._init_db()
+        now = time.time()
+        db = get_db()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO token_cache VALUES (?, ?, ?, ?)", rows)
+            if now - self._last_sweep > self.SWEEP_INTERVAL:
+                db.execute("DELETE FROM token_cache WHERE expires_at <= ?", (now,))
+                self._last_sweep = now
+
+    async def get_many(self, keys):
+        rows = await run_db(self._get_many, keys)
+        self.hits += len(rows)
+        self.misses += len(keys) - len(rows)
+        return {key: PairSnapshot(*json_loads(data)) for key, data in rows.items()}
+
+    async def put_many(self, items):
+        expires_at = time.time() + self.ttl
+        rows = [(*key, expires_at, json.dumps(astuple(pair))) for key, pair in items]
+        if rows:
+            await run_db(self._put_many, rows)
+            self.writes += len(rows)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "writes": self.writes}
+
+shared_token_cache = SharedTokenCache(TOKEN_CACHE_TTL) if SHARDS > 1 else None
+
+# ---------------- Logo Cache ----------------
+def logo_digest(img_bytes, size):
+    return hashlib.sha256(img_bytes + f"|{size[0]}x{size[1]}".encode()).hexdigest()
+
+class LogoCache:
+    # Content-addressed cache of processed logo PNGs (keyed by a digest of the source bytes
+    # and target size), an LRU memory tier capped by total bytes, an optional on-disk tier,
+    # and the Telegram file_id each logo was uploaded as. A URL's link to its digest expires
+    # after url_ttl, so a logo replaced at the same URL is picked up again. The disk tier is
+    # swept every SWEEP_INTERVAL: least recently used files go once it outgrows disk_max_bytes.
+    MAX_URLS = 10_000
+    SWEEP_INTERVAL = 600
+
+    def __init__(self, max_bytes, disk_dir=None, url_ttl=LOGO_URL_TTL, disk_max_bytes=LOGO_CACHE_DIR_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.url_ttl = url_ttl
+        self.disk_max_bytes = disk_max_bytes
+        self._png = OrderedDict()    # digest -> png bytes
+        self._png_bytes = 0
+        self._urls = OrderedDict()   # (url, size) -> (linked_at, digest)
+        self._last_sweep = 0.0
+        self.swept = 0
+        self._file_ids = {}          # digest -> telegram file_id
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.file_id_hits = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, name):
+        return os.path.join(self.disk_dir, name)
+
+    @staticmethod
+    def _url_name(url, size):
+        return "url-" + hashlib.sha256(f"{url}|{size[0]}x{size[1]}".encode()).hexdigest()
+
+    def _read_disk(self, name):
+        try:
+            with open(self._disk_path(name), "rb") as f:
+                data = f.read()
+            os.utime(self._disk_path(name))  # the sweep drops least recently used files first
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, name, data):
+        try:
+            tmp = self._disk_path(f"{name}.{os.getpid()}.tmp")  # shards may write the same logo at once
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._disk_path(name))
+        except OSError as e:
+            print(f"Could not write logo cache file: {e}")
+
+    async def _disk(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def digest_for_url(self, url, size):
+        # None when the URL is unknown or its link is stale; the caller downloads it again
+        key = (url, size)
+        stale_before = time.time() - self.url_ttl
+        entry = self._urls.get(key)
+        if entry:
+            if entry[0] >= stale_before:
+                self._urls.move_to_end(key)
+                return entry[1]
+            del self._urls[key]
+            return None
+        if self.disk_dir:
+            data = await self._disk(self._read_disk, self._url_name(url, size))
+            if data:
+                digest, _, linked_at = data.decode().partition(" ")
+                linked_at = float(linked_at or 0)  # links written without a timestamp count as stale
+                if linked_at < stale_before:
+                    return None
+                self._remember_url(key, digest, linked_at)
+                if digest not in self._file_ids:
+                    file_id = await self._disk(self._read_disk, f"{digest}.file_id")
+                    if file_id:
+                        self._file_ids[digest] = file_id.decode()
+                return digest
+        return None
+
+    def _remember_url(self, key, digest, linked_at):
+        self._urls[key] = (linked_at, digest)
+        self._urls.move_to_end(key)
+        while len(self._urls) > self.MAX_URLS:
+            self._urls.popitem(last=False)
+
+    async def link_url(self, url, size, digest):
+        linked_at = time.time()
+        self._remember_url((url, size), digest, linked_at)
+        if self.disk_dir:
+            await self._disk(self._write_disk, self._url_name(url, size), f"{digest} {linked_at}".encode())
+
+    async def get_png(self, digest):
+        png = self._png.get(digest)
+        if png is not None:
+            self._png.move_to_end(digest)
+            self.hits += 1
+            return png
+        if self.disk_dir:
+            png = await self._disk(self._read_disk, f"{digest}.png")
+            if png:
+                self.disk_hits += 1
+                self._store(digest, png)
+                return png
+        self.misses += 1
+        return None
+
+    async def put_png(self, digest, png):
+        self._store(digest, png)
+        if self.disk_dir:
+            await self._disk(self._write_disk, f"{digest}.png", png)
+            if time.time() - self._last_sweep > self.SWEEP_INTERVAL:
+                self._last_sweep = time.time()
+                self.swept += await self._disk(self._sweep_disk)
+
+    def _sweep_disk(self):
+        # Expired URL links go first, then the least recently used files until the
+        # directory is back under 90% of its budget; returns the number of files removed
+        files = []
+        removed = 0
+        stale_before = time.time() - self.url_ttl
+        with os.scandir(self.disk_dir) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith("url-") and stat.st_mtime < stale_before:
+                    self._remove_disk(entry.name)
+                    removed += 1
+                elif entry.is_file():
+                    files.append((stat.st_mtime, stat.st_size, entry.name))
+        total = sum(size for _, size, _ in files)
+        if total > self.disk_max_bytes:
+            for _, size, name in sorted(files):
+                if total <= self.disk_max_bytes * 0.9:
+                    break
+                self._remove_disk(name)
+                total -= size
+                removed += 1
+        return removed
+
+    def _store(self, digest, png):
+        if len(png) > self.max_bytes:
+            return
+        old = self._png.pop(digest, None)
+        if old is not None:
+            self._png_bytes -= len(old)
+        self._png[digest] = png
+        self._png_bytes += len(png)
+        while self._png_bytes > self.max_bytes:
+            _, evicted = self._png.popitem(last=False)
+            self._png_bytes -= len(evicted)
+            self.evictions += 1
+
+    def get_file_id(self, digest):
+        file_id = self._file_ids.get(digest)
+        if file_id:
+            self.file_id_hits += 1
+        return file_id
+
+    async def set_file_id(self, digest, file_id):
+        self._file_ids[digest] = file_id
+        if self.disk_dir:
+            await self._disk(self._write_disk, f"{digest}.file_id", file_id.encode())
+
+    def _remove_disk(self, name):
+        try:
+            os.remove(self._disk_path(name))
+        except OSError:
+            pass
+
+    async def forget_file_id(self, digest):
+        self._file_ids.pop(digest, None)
+        if self.disk_dir:
+            await self._disk(self._remove_disk, f"{digest}.file_id")
+
+    def stats(self):
+        return {
+            "entries": len(self._png),
+            "bytes": self._png_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "file_ids": len(self._file_ids),
+            "file_id_hits": self.file_id_hits,
+            "swept": self.swept,
+        }
+
+logo_cache = LogoCache(LOGO_CACHE_MAX_BYTES, LOGO_CACHE_DIR)
+
+# ---------------- Pair Model ----------------
+# orjson decodes the large DexScreener responses several times faster; json is the fallback
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+def to_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+@dataclass(slots=True)
+class PairSnapshot:
+    # The fields we render or rank on, parsed once per API response. Everything downstream
+    # (caches, snapshots, leaderboard, formatting) holds these instead of raw JSON dicts.
+    chain_id: str
+    dex_id: str
+    pair_address: str
+    base_address: str
+    base_name: str
+    base_symbol: str
+    quote_address: str
+    price_usd: float | None
+    change_h1: float
+    change_h6: float
+    change_h24: float
+    volume_h24: float
+    liquidity_usd: float
+    fdv: float
+    market_cap: float
+    image_url: str | None
+
+    @classmethod
+    def from_dexscreener(cls, raw):
+        base = raw.get('baseToken') or {}
+        quote = raw.get('quoteToken') or {}
+        changes = raw.get('priceChange') or {}
+        return cls(
+            chain_id=sys.intern(raw.get('chainId') or ""),
+            dex_id=sys.intern(raw.get('dexId') or ""),
+            pair_address=raw.get('pairAddress') or "",
+            base_address=base.get('address') or "",
+            base_name=base.get('name') or "",
+            base_symbol=base.get('symbol') or "",
+            quote_address=quote.get('address') or "",
+            price_usd=to_float(raw.get('priceUsd'), None),
+            change_h1=to_float(changes.get('h1')),
+            change_h6=to_float(changes.get('h6')),
+            change_h24=to_float(changes.get('h24')),
+            volume_h24=to_float((raw.get('volume') or {}).get('h24')),
+            liquidity_usd=to_float((raw.get('liquidity') or {}).get('usd')),
+            fdv=to_float(raw.get('fdv')),
+            market_cap=to_float(raw.get('marketCap')),
+            image_url=(raw.get('info') or {}).get('imageUrl') or base.get('imageUrl'),
+        )
+
+# ---------------- Market Snapshots ----------------
+class SnapshotStore:
+    # Latest pair data for tokens the background refresher tracks. Handlers read from
+    # here first, so lookups of trending tokens never wait on the network.
+    def __init__(self, max_age=SNAPSHOT_MAX_AGE):
+        self.max_age = max_age
+        self._data = {}  # token_cache_key -> (fetched_at, pair)
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, chain_id, token_address):
+        entry = self._data.get(token_cache_key(chain_id, token_address))
+        if entry is None or entry[0] < time.time() - self.max_age:
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, chain_id, token_address, pair):
+        self._data[token_cache_key(chain_id, token_address)] = (time.time(), pair)
+
+    def items(self):
+        return [(key, pair) for key, (_, pair) in self._data.items()]
+
+    def retain(self, keys):
+        for key in [k for k in self._data if k not in keys]:
+            del self._data[key]
+
+market_snapshots = SnapshotStore()
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after=None):
+        try:
+            self.retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            self.retry_after = None
+        super().__init__(f"rate limited (retry after {self.retry_after or '?'}s)")
+
+# ---------------- Market Data Providers ----------------
+# Every provider normalises its response into PairSnapshot objects.
+class MarketDataProvider:
+    name = None
+    chains = None  # chain ids served, None for chain-agnostic lookups
+
+    def supports(self, chain_id):
+        if self.chains is None:
+            return True
+        return chain_id is not None and chain_id.lower() in self.chains
+
+    async def fetch_pairs(self, addresses, chain_id=None):
+        raise NotImplementedError
+
+class DexScreenerProvider(MarketDataProvider):
+    name = "dexscreener"
+
+    async def fetch_pairs(self, addresses, chain_id=None):
+        # One call to the tokens endpoint, which accepts up to DEXSCREENER_BATCH_SIZE addresses
+        url = f"{DEXSCREENER_API_URL}/latest/dex/tokens/{','.join(addresses)}"
+        async with get_http_session().get(url) as response:
+            if response.status == 429:
+                raise RateLimitedError(response.headers.get("Retry-After"))
+            if response.status != 200:
+                raise ValueError(f"DexScreener returned HTTP {response.status}")
+            data = json_loads(await response.read()) or {}
+        return [PairSnapshot.from_dexscreener(pair) for pair in data.get('pairs') or []]
+
+class GeckoTerminalProvider(MarketDataProvider):
+    # Keyless public API, one network per request, so it only serves chain-specific lookups
+    name = "geckoterminal"
+    NETWORKS = {"ethereum": "eth", "bsc": "bsc", "base": "base", "arbitrum": "arbitrum", "solana": "solana"}
+    chains = set(NETWORKS)
+
+    async def fetch_pairs(self, addresses, chain_id=None):
+        network = self.NETWORKS[chain_id.lower()]
+        url = f"{GECKOTERMINAL_API_URL}/networks/{network}/tokens/multi/{','.join(addresses)}?include=top_pools"
+        async with get_http_session().get(url, headers={"Accept": "application/json"}) as response:
+            if response.status == 429:
+                raise RateLimitedError(response.headers.get("Retry-After"))
+            if response.status == 404:
+                return []
+            if response.status != 200:
+                raise ValueError(f"GeckoTerminal returned HTTP {response.status}")
+            data = json_loads(await response.read()) or {}
+        tokens = {}
+        for token in data.get('data') or []:
+            attributes = token.get('attributes') or {}
+            tokens[normalize_address(attributes.get('address'))] = attributes
+        return [
+            self.normalize(pool, tokens, chain_id.lower())
+            for pool in data.get('included') or [] if pool.get('type') == 'pool'
+        ]
+
+    @staticmethod
+    def _related_id(relationships, name):
+        return (((relationships or {}).get(name) or {}).get('data') or {}).get('id') or ""
+
+    def normalize(self, pool, tokens, chain_id):
+        attributes = pool.get('attributes') or {}
+        relationships = pool.get('relationships') or {}
+        # Related ids look like "eth_0xabc..." and "uniswap_v3"
+        base_address = self._related_id(relationships, 'base_token').split("_", 1)[-1]
+        quote_address = self._related_id(relationships, 'quote_token').split("_", 1)[-1]
+        base_symbol = (attributes.get('name') or "").partition(" / ")[0]
+        base = tokens.get(normalize_address(base_address)) or {}
+        changes = attributes.get('price_change_percentage') or {}
+        image_url = base.get('image_url')
+        return PairSnapshot(
+            chain_id=sys.intern(chain_id),
+            dex_id=sys.intern(self._related_id(relationships, 'dex')),
+            pair_address=attributes.get('address') or "",
+            base_address=base_address,
+            base_name=base.get('name') or base_symbol,
+            base_symbol=base.get('symbol') or base_symbol,
+            quote_address=quote_address,
+            price_usd=to_float(attributes.get('base_token_price_usd'), None),
+            change_h1=to_float(changes.get('h1')),
+            change_h6=to_float(changes.get('h6')),
+            change_h24=to_float(changes.get('h24')),
+            volume_h24=to_float((attributes.get('volume_usd') or {}).get('h24')),
+            liquidity_usd=to_float(attributes.get('reserve_in_usd')),
+            fdv=to_float(attributes.get('fdv_usd')),
+            market_cap=to_float(attributes.get('market_cap_usd')),
+            image_url=image_url if image_url and image_url != "missing.png" else None,
+        )
+
+MARKET_PROVIDER_CLASSES = {"dexscreener": DexScreenerProvider, "geckoterminal": GeckoTerminalProvider}
+
+class ProviderHealth:
+    # Latency window for the hedge delay plus a consecutive-failure circuit breaker
+    WINDOW = 200
+
+    def __init__(self):
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.trips = 0
+
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    def record_success(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.failures = 0
+
+    def record_cancelled(self, latency):
+        # A hedge loser was still waiting after `latency`, which is a lower bound on its latency;
+        # keeping the sample stops p95 from only ever seeing the faster provider
+        self.requests += 1
+        self.latencies.append(latency)
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            # Stays open for the cooldown; after that one more failure re-opens it straight away
+            if self.available():
+                self.trips += 1
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    def p95(self):
+        if len(self.latencies) < 20:
+            return None
+        return sorted(self.latencies)[int(len(self.latencies) * 0.95)]
+
+    def hedge_delay(self):
+        p95 = self.p95()
+        return HEDGE_DELAY if p95 is None else min(max(p95, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+class MarketDataClient:
+    # Asks providers in MARKET_PROVIDERS order. If the current one hasn't answered after its
+    # own p95 latency, the next one is fired as well (a hedged request) and whichever answers
+    # first wins; a failure moves on to the next provider immediately. Providers whose
+    # circuit is open are skipped unless nothing else can serve the lookup.
+    def __init__(self, names):
+        unknown = [n for n in names if n not in MARKET_PROVIDER_CLASSES]
+        if unknown or not names:
+            raise ValueError(f"❌ Unknown MARKET_PROVIDERS {unknown}, choose from {', '.join(MARKET_PROVIDER_CLASSES)}")
+        self.providers = [MARKET_PROVIDER_CLASSES[n]() for n in names]
+        self.health = {p.name: ProviderHealth() for p in self.providers}
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def _candidates(self, chain_id):
+        supporting = [p for p in self.providers if p.supports(chain_id)]
+        healthy = [p for p in supporting if self.health[p.name].available()]
+        return healthy or supporting
+
+    async def _call(self, provider, addresses, chain_id):
+        health = self.health[provider.name]
+        IN_FLIGHT.inc(provider.name)
+        started = time.perf_counter()
+        try:
+            pairs = await provider.fetch_pairs(addresses, chain_id)
+            latency = time.perf_counter() - started
+            health.record_success(latency)
+            PROVIDER_SECONDS.observe(latency, provider.name)
+            return pairs
+        except asyncio.CancelledError:
+            health.record_cancelled(time.perf_counter() - started)
+            raise
+        except Exception as e:
+            health.record_failure()
+            ERRORS.inc(provider.name, type(e).__name__)
+            raise
+        finally:
+            IN_FLIGHT.dec(provider.name)
+
+    async def fetch_pairs(self, addresses, chain_id=None, hedge=True):
+        remaining = self._candidates(chain_id)
+        if not remaining:
+            raise ValueError(f"no market data provider serves {chain_id}")
+        pending = {}  # task -> provider
+        hedges = set()  # tasks started because the current one was too slow
+        errors = []
+
+        def launch():
+            provider = remaining.pop(0)
+            task = asyncio.create_task(self._call(provider, addresses, chain_id))
+            pending[task] = provider
+            return provider, task
+
+        current, _ = launch()
+        try:
+            while pending:
+                timeout = self.health[current.name].hedge_delay() if hedge and remaining else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedged += 1
+                    current, task = launch()
+                    hedges.add(task)
+                    continue
+                for task in done:
+                    pending.pop(task)
+                    if task.exception() is None:
+                        if task in hedges:
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append(task.exception())
+                if remaining and not pending:
+                    self.failovers += 1
+                    current, _ = launch()
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "providers": {
+                name: {
+                    "requests": health.requests,
+                    "errors": health.errors,
+                    "trips": health.trips,
+                    "open": not health.available(),
+                    "p95": health.p95(),
+                }
+                for name, health in self.health.items()
+            },
+        }
+
+market_data = MarketDataClient(MARKET_PROVIDERS)
+
+# ---------------- Utils ----------------
+async def fetch_token_info(chain_id: str, token_address: str):
+    with FETCH_TOKEN_SECONDS.time():
+        pair = market_snapshots.get(chain_id, token_address)
+        if pair is not None:
+            return pair
+        key = token_cache_key(chain_id, token_address)
+        return await token_cache.get_or_load(key, lambda: _fetch_token_info_uncached(chain_id, token_address))
+
+async def _fetch_token_info_uncached(chain_id: str, token_address: str):
+    key = token_cache_key(chain_id, token_address)
+    try:
+        if shared_token_cache:
+            pair = (await shared_token_cache.get_many([key])).get(key)
+            if pair is not None:
+                return pair
+        pairs = await market_data.fetch_pairs([token_address], chain_id)
+        pair = select_best_pair(pairs, chain_id)
+        if pair is not None and shared_token_cache:
+            await shared_token_cache.put_many([(key, pair)])
+        return pair
+    except Exception as e:
+        print(f"Error fetching token info: {e}")
+    return None
+
+def select_best_pair(pairs, chain_id):
+    # Deepest-liquidity pair on the requested chain, falling back to the first pair anywhere
+    if not pairs:
+        return None
+    chain_pairs = [p for p in pairs if p.chain_id.lower() == chain_id.lower()]
+    if chain_pairs:
+        return max(chain_pairs, key=lambda x: x.liquidity_usd)
+    return pairs[0]
+
+def pairs_for_address(pairs, token_address):
+    address = normalize_address(token_address)
+    return [
+        p for p in pairs
+        if normalize_address(p.base_address) == address or normalize_address(p.quote_address) == address
+    ]
+
+async def fetch_tokens_info(chain_id: str, token_addresses):
+    # Batched fetch_token_info: returns {address: pair or None}, fetching cache misses
+    # DEXSCREENER_BATCH_SIZE addresses per request with all chunks in flight concurrently.
+    # Misses join loads already in flight, and the batch's own loads are registered with
+    # token_cache, so concurrent single lookups of the same tokens share them too.
+    results = {}
+    missing = []
+    for address in dict.fromkeys(a.strip() for a in token_addresses if a.strip()):
+        pair = market_snapshots.get(chain_id, address) or token_cache.get(token_cache_key(chain_id, address))
+        results[address] = pair
+        if pair is None:
+            missing.append(address)
+    token_cache.hits += len(results) - len(missing)
+    if missing and shared_token_cache:
+        keys = {token_cache_key(chain_id, address): address for address in missing}
+        for key, pair in (await shared_token_cache.get_many(list(keys))).items():
+            token_cache.set(key, pair)
+            results[keys[key]] = pair
+        missing = [address for address in missing if results[address] is None]
+
+    async def fetch_chunk(chunk):
+        try:
+            pairs = await market_data.fetch_pairs(chunk, chain_id)
+        except Exception as e:
+            print(f"Error fetching token batch: {e}")
+            return {}
+        found = {address: select_best_pair(pairs_for_address(pairs, address), chain_id) for address in chunk}
+        if shared_token_cache:
+            await shared_token_cache.put_many(
+                (token_cache_key(chain_id, address), pair) for address, pair in found.items() if pair is not None
+            )
+        return found
+
+    async def pick(chunk_task, address):
+        return (await chunk_task).get(address)
+
+    loads = {}
+    own = []
+    for address in missing:
+        task = token_cache.pending(token_cache_key(chain_id, address))
+        if task is not None:
+            token_cache.coalesced += 1
+            loads[address] = task
+        else:
+            own.append(address)
+    token_cache.misses += len(own)
+    for i in range(0, len(own), DEXSCREENER_BATCH_SIZE):
+        chunk = own[i:i + DEXSCREENER_BATCH_SIZE]
+        # Own tasks, so a cancelled caller doesn't fail lookups that joined the batch
+        chunk_task = asyncio.ensure_future(fetch_chunk(chunk))
+        for address in chunk:
+            loads[address] = asyncio.ensure_future(pick(chunk_task, address))
+            token_cache.track(token_cache_key(chain_id, address), loads[address])
+    pairs = await asyncio.gather(*(asyncio.shield(task) for task in loads.values()), return_exceptions=True)
+    for address, pair in zip(loads, pairs):
+        results[address] = None if isinstance(pair, BaseException) else pair
+    return results
+
+def format_number(num):
+    try:
+        num = float(num)
+        if num >= 1_000_000_000:
+            return f"${num/1_000_000_000:.2f}B"
+        elif num >= 1_000_000:
+            return f"${num/1_000_000:.2f}M"
+        elif num >= 1_000:
+            return f"${num/1_000:.2f}K"
+        else:
+            return f"${num:.2f}"
+    except:
+        return "N/A"
+
+def format_percentage(num):
+    try:
+        num = float(num)
+        if num > 0: return f"🟢 +{num:.2f}%"
+        elif num < 0: return f"🔴 {num:.2f}%"
+        else: return f"⚪ {num:.2f}%"
+    except:
+        return "⚪ N/A"
+
+# ---------------- Image Processing ----------------
+# Pillow work is CPU-bound and would block every handler on the event loop, so it runs
+# in a thread or process pool (IMAGE_POOL) with at most IMAGE_MAX_JOBS jobs in flight.
+image_pool = None
+image_jobs = asyncio.Semaphore(IMAGE_MAX_JOBS)
+
+def get_image_pool():
+    global image_pool
+    if image_pool is None:
+        if IMAGE_POOL == "process":
+            image_pool = ProcessPoolExecutor(max_workers=IMAGE_POOL_WORKERS)
+        else:
+            image_pool = ThreadPoolExecutor(max_workers=IMAGE_POOL_WORKERS, thread_name_prefix="image")
+    return image_pool
+
+def shutdown_image_pool():
+    global image_pool
+    if image_pool is not None:
+        image_pool.shutdown(wait=False, cancel_futures=True)
+        image_pool = None
+
+async def run_image_job(fn, *args):
+    async with image_jobs:
+        return await asyncio.get_running_loop().run_in_executor(get_image_pool(), fn, *args)
+
+async def download_image(url, max_bytes=IMAGE_MAX_BYTES):
+    # Streams the body and gives up as soon as it grows past max_bytes
+    async with get_http_session().get(url) as resp:
+        if resp.status != 200:
+            raise ValueError(f"logo download failed with HTTP {resp.status}")
+        if resp.content_length and resp.content_length > max_bytes:
+            raise ValueError(f"logo is {resp.content_length} bytes, limit is {max_bytes}")
+        chunks = []
+        received = 0
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            received += len(chunk)
+            if received > max_bytes:
+                raise ValueError(f"logo exceeds {max_bytes} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+def _process_logo(img_bytes, size, max_pixels=IMAGE_MAX_PIXELS):
+    # Returns (png, decode_seconds, encode_seconds); decode covers compositing and resizing too
+    started = time.perf_counter()
+    img = Image.open(BytesIO(img_bytes))
+    # Image.open only parses the header, so this check runs before any pixel data is decoded
+    if img.size[0] * img.size[1] > max_pixels:
+        raise ValueError(f"logo is {img.size[0]}x{img.size[1]}, limit is {max_pixels} pixels")
+
+    # Convert to RGB if necessary
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        if img.mode in ('RGBA', 'LA'):
+            background.paste(img, mask=img.split()[-1])
+        else:
+            background.paste(img)
+        img = background
+
+    # Create square canvas with padding
+    max_dim = max(img.size)
+    square_img = Image.new('RGB', (max_dim, max_dim), (255, 255, 255))
+    offset = ((max_dim - img.size[0]) // 2, (max_dim - img.size[1]) // 2)
+    square_img.paste(img, offset)
+
+    # Resize to target size
+    square_img.thumbnail(size, Image.Resampling.LANCZOS)
+
+    decoded = time.perf_counter()
+    bio = BytesIO()
+    square_img.save(bio, format="PNG", quality=95)
+    return bio.getvalue(), decoded - started, time.perf_counter() - decoded
+
+def _png_file(png):
+    bio = BytesIO(png)
+    bio.name = "logo.png"
+    return bio
+
+async def load_logo(url, size=(300,300), use_file_id=True):
+    # Returns (digest, file_id, png) for a logo, or None when it can't be loaded.
+    # A known Telegram file_id short-circuits everything: no download, no re-encode, no upload.
+    try:
+        digest = await logo_cache.digest_for_url(url, size)
+        if digest:
+            file_id = logo_cache.get_file_id(digest) if use_file_id else None
+            if file_id:
+                return digest, file_id, None
+            png = await logo_cache.get_png(digest)
+            if png:
+                return digest, None, png
+
+        with LOGO_SECONDS.time("download"):
+            img_bytes = await download_image(url)
+        digest = logo_digest(img_bytes, size)
+        await logo_cache.link_url(url, size, digest)
+        file_id = logo_cache.get_file_id(digest) if use_file_id else None
+        if file_id:
+            return digest, file_id, None
+        png = await logo_cache.get_png(digest)
+        if png is None:
+            png, decode_seconds, encode_seconds = await run_image_job(_process_logo, img_bytes, size)
+            LOGO_SECONDS.observe(decode_seconds, "decode")
+            LOGO_SECONDS.observe(encode_seconds, "encode")
+            await logo_cache.put_png(digest, png)
+        return digest, None, png
+    except Exception as e:
+        ERRORS.inc("logo", type(e).__name__)
+        print(f"Error resizing image: {e}")
+        return None
+
+async def resize_image(url, size=(300,300)):
+    logo = await load_logo(url, size, use_file_id=False)
+    return _png_file(logo[2]) if logo else None
+
+async def answer_logo_photo(message: types.Message, logo_url, logo, **kwargs):
+    digest, file_id, png = logo
+    if file_id:
+        try:
+            return await outbox.answer_photo(message, file_id, **kwargs)
+        except TelegramAPIError as e:
+            print(f"Cached logo file_id rejected, re-uploading: {e}")
+            await logo_cache.forget_file_id(digest)
+            logo = await load_logo(logo_url, use_file_id=False)
+            if not logo:
+                raise
+            digest, _, png = logo
+    sent = await outbox.answer_photo(message, _png_file(png), **kwargs)
+    if sent.photo:
+        await logo_cache.set_file_id(digest, sent.photo[-1].file_id)
+    return sent
+
+def format_price(price_usd):
+    try:
+        price_float = float(price_usd)
+        if price_float < 0.000001: return f"${price_float:.10f}"
+        elif price_float < 0.01: return f"${price_float:.8f}"
+        else: return f"${price_float:.6f}"
+    except: return "N/A"
+
+def create_professional_message(pair_data: PairSnapshot, chain_name):
+    if not pair_data:
+        return None, None, None
+    price_usd = pair_data.price_usd
+    price_change_h24 = pair_data.change_h24
+    price_change_h6 = pair_data.change_h6
+    price_change_h1 = pair_data.change_h1
+    volume_24h = pair_data.volume_h24
+    liquidity = pair_data.liquidity_usd
+    fdv = pair_data.fdv
+    market_cap = pair_data.market_cap
+    pair_chain = pair_data.chain_id or 'Unknown'
+    dex_name = pair_data.dex_id or 'Unknown'
+    pair_address = pair_data.pair_address
+    logo_url = pair_data.image_url
+
+    price_display = format_price(price_usd)
+
+    network_emoji = NETWORK_EMOJIS.get(pair_chain.lower(),"🔗")
+
+    message = (
+        f"╔══════════════════════════╗\n"
+        f"     <b>🎯 TOKEN ANALYTICS</b>\n"
+        f"╚══════════════════════════╝\n\n"
+        f"{network_emoji} <b>{pair_data.base_symbol or 'Unknown'}</b> • {pair_data.base_name or 'Unknown'}\n"
+        f"🏦 <b>DEX:</b> {dex_name.upper()}\n"
+        f"⛓️ <b>Chain:</b> {pair_chain.upper()}\n\n"
+        f"┏━━━━━━━━━━━━━━━━━━━━━━━━┓\n"
+        f"┃  <b>💰 PRICE INFORMATION</b>   ┃\n"
+        f"┗━━━━━━━━━━━━━━━━━━━━━━━━┛\n"
+        f"💵 <b>Current Price:</b> {price_display}\n\n"
+        f"📊 <b>Price Changes:</b>\n"
+        f"  • 1H:  {format_percentage(price_change_h1)}\n"
+        f"  • 6H:  {format_percentage(price_change_h6)}\n"
+        f"  • 24H: {format_percentage(price_change_h24)}\n\n"
+        f"┏━━━━━━━━━━━━━━━━━━━━━━━━┓\n"
+        f"┃  <b>📈 MARKET STATISTICS</b>   ┃\n"
+        f"┗━━━━━━━━━━━━━━━━━━━━━━━━┛\n"
+        f"💎 <b>Market Cap:</b> {format_number(market_cap)}\n"
+        f"🌊 <b>Liquidity:</b> {format_number(liquidity)}\n"
+        f"📊 <b>24h Volume:</b> {format_number(volume_24h)}\n"
+        f"💹 <b>FDV:</b> {format_number(fdv)}\n\n"
+        f"┏━━━━━━━━━━━━━━━━━━━━━━━━┓\n"
+        f"┃  <b>📝 CONTRACT INFO</b>       ┃\n"
+        f"┗━━━━━━━━━━━━━━━━━━━━━━━━┛\n"
+        f"<code>{pair_data.base_address or 'N/A'}</code>\n"
+    )
+    chart_url = f"https://dexscreener.com/{pair_chain}/{pair_address}" if pair_address else None
+    return logo_url, message, chart_url
+
+def create_compact_line(pair_data, token_address):
+    # One-line summary used when several CAs are analysed in one message
+    if not pair_data:
+        return f"❓ <code>{token_address}</code> — not found"
+    pair_chain = pair_data.chain_id
+    pair_address = pair_data.pair_address
+    symbol = pair_data.base_symbol or 'Unknown'
+    if pair_address:
+        symbol = f"<a href='https://dexscreener.com/{pair_chain}/{pair_address}'>{symbol}</a>"
+    return (
+        f"{NETWORK_EMOJIS.get(pair_chain.lower(),'🔗')} <b>{symbol}</b> • {format_price(pair_data.price_usd)} • "
+        f"{format_percentage(pair_data.change_h24)}\n"
+        f"   MC {format_number(pair_data.market_cap)} | Liq {format_number(pair_data.liquidity_usd)} | "
+        f"Vol {format_number(pair_data.volume_h24)}\n"
+        f"   <code>{token_address}</code>"
+    )
+
+def parse_contract_addresses(text):
+    return list(dict.fromkeys(a for a in re.split(r"[\s,;]+", text or "") if a))
+
+# ---------------- Campaign Scheduler ----------------
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+class CampaignScheduler:
+    # Trending campaigns live in the `campaigns` table; one dispatcher task pops start and
+    # expiry events off a heap and sleeps until the next one, however many campaigns run.
+    # On startup every live campaign is re-queued, so anything that expired while the bot
+    # was down fires immediately. Heap entries made stale by extend/cancel are skipped
+    # when popped by comparing them against the campaign's current times. Start/expire
+    # callbacks run as background tasks, so a slow send never holds up the other timers.
+    def __init__(self):
+        self.live = {}             # campaign id -> campaign dict (scheduled or active)
+        self._heap = []            # (when, seq, kind, campaign id)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._activating = set()   # ids mid-activation, so a double click and the watcher can't both win
+        self.on_start = []         # async callbacks(campaign)
+        self.on_expire = []        # async callbacks(campaign)
+        self._callbacks = set()    # running callback tasks
+
+    @staticmethod
+    def _init_db():
+        db = get_db()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS campaigns ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, network TEXT NOT NULL,"
+                " token TEXT NOT NULL, package TEXT NOT NULL, amount REAL NOT NULL DEFAULT 0,"
+                " status TEXT NOT NULL, created_at REAL NOT NULL, starts_at REAL, expires_at REAL)"
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(campaigns)")}
+            if "tx_hash" not in columns:
+                db.execute("ALTER TABLE campaigns ADD COLUMN tx_hash TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS campaigns_status ON campaigns (status, expires_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS campaigns_user ON campaigns (user_id)")
+            db.execute("CREATE INDEX IF NOT EXISTS campaigns_token ON campaigns (network, token)")
+        return fetch_dicts("SELECT * FROM campaigns WHERE status IN ('scheduled', 'active')")
+
+    @staticmethod
+    def _update(campaign_id, **fields):
+        db = get_db()
+        with db:
+            db.execute(f"UPDATE campaigns SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                       (*fields.values(), campaign_id))
+
+    async def start(self):
+        for campaign in await run_db(self._init_db):
+            self.live[campaign['id']] = campaign
+            if campaign['status'] == 'scheduled':
+                self._push(campaign['starts_at'], "start", campaign['id'])
+            else:
+                self._push(campaign['expires_at'], "expire", campaign['id'])
+        overdue = sum(1 for c in self.live.values() if c['expires_at'] <= time.time())
+        print(f"⏰ Restored {len(self.live)} trending campaigns ({overdue} expired while offline)")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._callbacks, return_exceptions=True)
+
+    def _push(self, when, kind, campaign_id):
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, kind, campaign_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                when, _, kind, campaign_id = heapq.heappop(self._heap)
+                try:
+                    await self._fire(when, kind, campaign_id)
+                except Exception as e:
+                    print(f"Error handling campaign {campaign_id} {kind}: {e}")
+            self._wakeup.clear()
+            timer = None
+            if self._heap:
+                delay = max(0, self._heap[0][0] - time.time())
+                timer = asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+            try:
+                await self._wakeup.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    async def _fire(self, when, kind, campaign_id):
+        campaign = self.live.get(campaign_id)
+        if campaign is None:
+            return
+        if kind == "start" and campaign['status'] == 'scheduled' and campaign['starts_at'] == when:
+            campaign['status'] = 'active'
+            await run_db(lambda: self._update(campaign_id, status='active'))
+            self._push(campaign['expires_at'], "expire", campaign_id)
+            self._notify(self.on_start, campaign)
+        elif kind == "expire" and campaign['status'] == 'active' and campaign['expires_at'] == when:
+            campaign['status'] = 'expired'
+            del self.live[campaign_id]
+            await run_db(lambda: self._update(campaign_id, status='expired'))
+            self._notify(self.on_expire, campaign)
+
+    def _notify(self, callbacks, campaign):
+        for callback in callbacks:
+            task = asyncio.create_task(self._callback(callback, campaign))
+            self._callbacks.add(task)
+            task.add_done_callback(self._callbacks.discard)
+
+    @staticmethod
+    async def _callback(callback, campaign):
+        try:
+            await callback(campaign)
+        except Exception as e:
+            print(f"Error in campaign callback {callback.__name__}: {e}")
+
+    async def create(self, user_id, network, token, package, amount=0):
+        def insert():
+            db = get_db()
+            with db:
+                return db.execute(
+                    "INSERT INTO campaigns (user_id, network, token, package, amount, status, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+                    (user_id, network, token, package, amount, time.time()),
+                ).lastrowid
+        return await run_db(insert)
+
+    async def create_order(self, user_id, network, token, package, base_amount):
+        # Returns (campaign id, amount to pay); the amount is picked and the order inserted
+        # under one write lock, which also covers the other shards' connections
+        def insert():
+            db = get_db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                amount = pick_payment_amount(db, network, base_amount)
+                campaign_id = db.execute(
+                    "INSERT INTO campaigns (user_id, network, token, package, amount, status, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+                    (user_id, network, token, package, amount, time.time()),
+                ).lastrowid
+            return campaign_id, amount
+        return await run_db(insert)
+
+    async def get(self, campaign_id):
+        if campaign_id in self.live:
+            return self.live[campaign_id]
+        rows = await run_db(fetch_dicts, "SELECT * FROM campaigns WHERE id = ?", (campaign_id,))
+        return rows[0] if rows else None
+
+    async def pending_orders(self, network, since):
+        return await run_db(
+            fetch_dicts,
+            "SELECT * FROM campaigns WHERE status = 'pending' AND network = ? AND created_at >= ? ORDER BY created_at",
+            (network, since),
+        )
+
+    async def activate(self, campaign_id, starts_at=None, tx_hash=None):
+        # Returns the activated campaign, or None if it isn't pending (unknown or already activated)
+        campaign = await self.get(campaign_id)
+        if campaign is None or campaign['status'] != 'pending' or campaign_id in self._activating:
+            return None
+        self._activating.add(campaign_id)
+        try:
+            return await self._activate(campaign, starts_at, tx_hash)
+        finally:
+            self._activating.discard(campaign_id)
+
+    async def _activate(self, campaign, starts_at, tx_hash):
+        campaign_id = campaign['id']
+        campaign['tx_hash'] = tx_hash
+        now = time.time()
+        starts_at = max(starts_at or now, now)
+        campaign['starts_at'] = starts_at
+        campaign['expires_at'] = starts_at + PACKAGE_DURATIONS.get(campaign['package'], 3 * 3600)
+        campaign['status'] = 'scheduled'
+        self.live[campaign_id] = campaign
+        await run_db(lambda: self._update(campaign_id, status='scheduled', starts_at=campaign['starts_at'],
+                                          expires_at=campaign['expires_at'], tx_hash=tx_hash))
+        self._push(starts_at, "start", campaign_id)
+        return campaign
+
+    async def extend(self, campaign_id, seconds):
+        campaign = self.live.get(campaign_id)
+        if campaign is None:
+            return None
+        campaign['expires_at'] += seconds
+        await run_db(lambda: self._update(campaign_id, expires_at=campaign['expires_at']))
+        if campaign['status'] == 'active':
+            self._push(campaign['expires_at'], "expire", campaign_id)
+        return campaign
+
+    async def cancel(self, campaign_id):
+        campaign = self.live.pop(campaign_id, None)
+        if campaign is None:
+            return None
+        campaign['status'] = 'cancelled'
+        await run_db(lambda: self._update(campaign_id, status='cancelled'))
+        self._notify(self.on_expire, campaign)
+        return campaign
+
+    def list(self, user_id=None, network=None, token=None):
+        token = normalize_address(token) if token else None
+        return sorted(
+            (c for c in self.live.values()
+             if (user_id is None or c['user_id'] == user_id)
+             and (network is None or c['network'] == network)
+             and (token is None or normalize_address(c['token']) == token)),
+            key=lambda c: c['expires_at'],
+        )
+
+campaign_scheduler = CampaignScheduler()
+
+async def notify_campaign_ended(campaign):
+    try:
+        await outbox.send_message(campaign['user_id'], "⏰ Your trending period has ended. Thank you for using OmniTrending!")
+    except Exception as e:
+        print(f"Could not notify user {campaign['user_id']} about campaign end: {e}")
+
+campaign_scheduler.on_expire.append(notify_campaign_ended)
+
+async def activate_campaign(campaign_id, tx_hash=None, actor=None):
+    # Shared by the support button and the payment watcher: activates a pending campaign
+    # and tells the buyer. Returns None when the campaign isn't pending any more.
+    campaign = await campaign_scheduler.activate(campaign_id, tx_hash=tx_hash)
+    if campaign is None:
+        return None
+    ledger.record("activation", campaign, tx_hash=tx_hash, actor=actor)
+    network = campaign['network']
+    user_activation_message = (
+        f"🎉 <b>TRENDING ACTIVATED!</b>\n\n"
+        f"{NETWORK_EMOJIS.get(network, '🔗')} <b>Network:</b> {network.upper()}\n"
+        f"⏰ <b>Duration:</b> {campaign['package'].upper()}\n"
+        f"🏁 <b>Ends:</b> {format_timestamp(campaign['expires_at'])}\n\n"
+        f"Your token is now trending! 🚀\n\n"
+        f"Thank you for using OmniTrending!"
+    )
+    await outbox.send_message(campaign['user_id'], user_activation_message)
+    return campaign
+
+def pick_payment_amount(db, network, base_amount):
+    # Networks watched on-chain get a price nudged by a few PAYMENT_AMOUNT_STEPs so every
+    # open order on that network has a distinct amount the watcher can match transfers to.
+    # Runs inside the transaction that inserts the order, so two orders can't pick the same one.
+    if network not in PAYMENT_RPC_URLS or not base_amount:
+        return base_amount
+    rows = db.execute(
+        "SELECT amount FROM campaigns WHERE status = 'pending' AND network = ? AND created_at >= ?",
+        (network, time.time() - PAYMENT_ORDER_TTL),
+    )
+    taken = {round(amount, 6) for (amount,) in rows}
+    for _ in range(100):
+        amount = round(base_amount + random.randint(1, 999) * PAYMENT_AMOUNT_STEP, 6)
+        if amount not in taken:
+            return amount
+    return base_amount
+
+# ---------------- Order Ledger ----------------
+class Ledger:
+    # Append-only history of every order: when a package is picked, claimed as paid,
+    # activated, extended, cancelled and expired. SQLite triggers reject UPDATE and DELETE on
+    # the table. record() only appends to a buffer; a background task writes the buffer in
+    # one transaction every flush_interval seconds, or sooner once batch_size events wait.
+    COLUMNS = ("ts", "event", "campaign_id", "user_id", "network", "token", "package", "amount", "tx_hash", "actor", "detail")
+
+    def __init__(self, flush_interval=LEDGER_FLUSH_INTERVAL, batch_size=LEDGER_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.written = 0
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @staticmethod
+    def _init_db():
+        db = get_db()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS ledger ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, event TEXT NOT NULL, campaign_id INTEGER,"
+                " user_id INTEGER, network TEXT, token TEXT, package TEXT, amount REAL, tx_hash TEXT, actor TEXT, detail TEXT)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS ledger_ts ON ledger (ts)")
+            db.execute("CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id, ts)")
+            db.execute("CREATE INDEX IF NOT EXISTS ledger_token ON ledger (token, ts)")
+            db.execute("CREATE INDEX IF NOT EXISTS ledger_network ON ledger (network, ts)")
+            db.execute("CREATE INDEX IF NOT EXISTS ledger_campaign ON ledger (campaign_id)")
+            # Covers /revenue, which only needs these columns of claims and activations
+            db.execute("CREATE INDEX IF NOT EXISTS ledger_event ON ledger (event, ts, network, amount)")
+            for action in ("UPDATE", "DELETE"):
+                db.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS ledger_no_{action.lower()} BEFORE {action} ON ledger"
+                    " BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END"
+                )
+
+    @classmethod
+    def _insert(cls, rows):
+        db = get_db()
+        with db:
+            db.executemany(
+                f"INSERT INTO ledger ({', '.join(cls.COLUMNS)}) VALUES ({', '.join('?' * len(cls.COLUMNS))})", rows
+            )
+
+    async def start(self):
+        await run_db(self._init_db)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            timer = asyncio.get_running_loop().call_later(self.flush_interval, self._wakeup.set)
+            try:
+                await self._wakeup.wait()
+            finally:
+                timer.cancel()
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error writing ledger: {e}")
+
+    def record(self, event, campaign=None, **fields):
+        row = {'ts': time.time(), 'event': event}
+        if campaign is not None:
+            row.update(campaign_id=campaign['id'], user_id=campaign['user_id'], network=campaign['network'],
+                       token=campaign['token'], package=campaign['package'], amount=campaign['amount'])
+        row.update(fields)
+        if row.get('token'):
+            row['token'] = normalize_address(row['token'])
+        self._buffer.append(tuple(row.get(c) for c in self.COLUMNS))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        try:
+            await run_db(self._insert, rows)
+        except Exception:
+            self._buffer[:0] = rows  # keep them for the next attempt
+            raise
+        self.written += len(rows)
+
+    async def events(self, user_id=None, network=None, token=None, campaign_id=None, limit=LEDGER_QUERY_LIMIT):
+        # Newest first; each filter is served by its own (column, ts) index
+        await self.flush()
+        filters = {"user_id": user_id, "network": network, "token": normalize_address(token) if token else None,
+                   "campaign_id": campaign_id}
+        filters = {k: v for k, v in filters.items() if v is not None}
+        where = " WHERE " + " AND ".join(f"{k} = ?" for k in filters) if filters else ""
+        return await run_db(fetch_dicts, f"SELECT * FROM ledger{where} ORDER BY ts DESC LIMIT ?", (*filters.values(), limit))
+
+    async def revenue(self, since):
+        await self.flush()
+        return await run_db(
+            fetch_dicts,
+            "SELECT network, event, COUNT(*) AS events, SUM(amount) AS amount FROM ledger"
+            " WHERE ts >= ? AND event IN ('claim', 'activation') GROUP BY network, event",
+            (since,),
+        )
+
+    def stats(self):
+        return {"written": self.written, "pending": len(self._buffer)}
+
+ledger = Ledger()
+
+async def record_campaign_expiry(campaign):
+    # on_expire also fires for cancellations, which /cancel records with who cancelled
+    if campaign['status'] == 'expired':
+        ledger.record("expiry", campaign, actor="scheduler")
+
+campaign_scheduler.on_expire.append(record_campaign_expiry)
+
+# ---------------- Leaderboard ----------------
+# Paid tier dominates the score so a bigger package always ranks above a smaller one;
+# live market data orders tokens within a tier.
+TIER_SCORES = {"3h": 100.0, "12h": 200.0, "24h": 300.0}
+
+def market_score(pair_data: PairSnapshot):
+    if not pair_data:
+        return 0.0
+    volume = max(pair_data.volume_h24, 0.0)
+    liquidity = max(pair_data.liquidity_usd, 0.0)
+    change = pair_data.change_h24
+    raw = 6 * math.log10(1 + volume) + 3 * math.log10(1 + liquidity) + max(-50.0, min(change, 200.0)) / 10
+    # Squashed into (0, 100) without changing the order, so it can't lift a token past the next tier
+    return 50 + 50 * math.tanh(raw / 50)
+
+class Leaderboard:
+    # Per-network ranking kept in a max-heap. Every score change pushes a fresh entry
+    # (O(log n)); the entry it replaces stays in the heap and is discarded as stale when it
+    # reaches the top. top(k) pops the k best live entries and pushes them back, so a
+    # publish costs O(k log n) rather than a full sort. The heap is rebuilt once stale
+    # entries outnumber live ones.
+    def __init__(self):
+        self._heaps = {}       # network -> [(-score, seq, token)]
+        self._entries = {}     # (network, token) -> {'score', 'seq', 'campaigns', 'pair', 'token'}
+        self._live = {}        # network -> number of ranked tokens
+        self._seq = 0
+        self.version = 0       # bumped on every change so publishers can skip idle ticks
+
+    def __len__(self):
+        return len(self._entries)
+
+    def tokens(self, network=None):
+        return [key for key in self._entries if network is None or key[0] == network]
+
+    def add_campaign(self, campaign, pair_data=None):
+        key = (campaign['network'], normalize_address(campaign['token']))
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {'campaigns': {}, 'pair': None, 'token': campaign['token'], 'seq': None}
+            self._live[key[0]] = self._live.get(key[0], 0) + 1
+        entry['campaigns'][campaign['id']] = campaign['package']
+        if pair_data is not None:
+            entry['pair'] = pair_data
+        self._rescore(key)
+
+    def remove_campaign(self, campaign):
+        key = (campaign['network'], normalize_address(campaign['token']))
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry['campaigns'].pop(campaign['id'], None)
+        if entry['campaigns']:
+            self._rescore(key)
+        else:
+            del self._entries[key]
+            self._live[key[0]] -= 1
+            self.version += 1
+
+    def update_market(self, network, token, pair_data):
+        key = (network, normalize_address(token))
+        entry = self._entries.get(key)
+        if entry is None or pair_data is None:
+            return
+        entry['pair'] = pair_data
+        self._rescore(key)
+
+    def _rescore(self, key):
+        entry = self._entries[key]
+        tier = max(TIER_SCORES.get(package, 0.0) for package in entry['campaigns'].values())
+        score = tier + market_score(entry['pair'])
+        if entry['seq'] is not None and entry['score'] == score:
+            return
+        self._seq += 1
+        entry['score'] = score
+        entry['seq'] = self._seq
+        heap = self._heaps.setdefault(key[0], [])
+        heapq.heappush(heap, (-score, self._seq, key[1]))
+        self.version += 1
+        if len(heap) > 2 * self._live[key[0]] + 64:
+            self._compact(key[0])
+
+    def _is_live(self, network, item):
+        entry = self._entries.get((network, item[2]))
+        return entry is not None and entry['seq'] == item[1]
+
+    def _compact(self, network):
+        heap = [item for item in self._heaps.get(network, []) if self._is_live(network, item)]
+        heapq.heapify(heap)
+        self._heaps[network] = heap
+
+    def top(self, network, k=LEADERBOARD_SIZE):
+        heap = self._heaps.get(network, [])
+        best = []
+        while heap and len(best) < k:
+            item = heapq.heappop(heap)
+            if self._is_live(network, item):
+                best.append(item)
+        for item in best:
+            heapq.heappush(heap, item)
+        return [(self._entries[(network, item[2])], -item[0]) for item in best]
+
+leaderboard = Leaderboard()
+
+async def leaderboard_add_campaign(campaign):
+    if campaign['token'] == "N/A":
+        return
+    # Only what's already cached; the market refresher tracks leaderboard tokens and fills in the rest
+    key = token_cache_key(CHAIN_IDS.get(campaign['network'], campaign['network']), campaign['token'])
+    leaderboard.add_campaign(campaign, market_snapshots.get(*key) or token_cache.get(key))
+
+async def leaderboard_remove_campaign(campaign):
+    leaderboard.remove_campaign(campaign)
+
+campaign_scheduler.on_start.append(leaderboard_add_campaign)
+campaign_scheduler.on_expire.append(leaderboard_remove_campaign)
+
+async def load_leaderboard():
+    # Campaigns restored by the scheduler on startup don't fire on_start again
+    by_network = {}
+    for campaign in campaign_scheduler.live.values():
+        if campaign['status'] == 'active' and campaign['token'] != "N/A":
+            by_network.setdefault(campaign['network'], []).append(campaign)
+    for network, campaigns in by_network.items():
+        chain_id = CHAIN_IDS.get(network, network)
+        pairs = await fetch_tokens_info(chain_id, [c['token'] for c in campaigns])
+        for campaign in campaigns:
+            leaderboard.add_campaign(campaign, pairs.get(campaign['token'].strip()))
+
+def render_leaderboard():
+    text = (
+        f"╔══════════════════════════╗\n"
+        f"  <b>🔥 OMNITRENDING LEADERBOARD</b>\n"
+        f"╚══════════════════════════╝\n\n"
+    )
+    medals = ["🥇", "🥈", "🥉"]
+    shown = False
+    for network, emoji in NETWORK_EMOJIS.items():
+        ranking = leaderboard.top(network)
+        if not ranking:
+            continue
+        shown = True
+        text += f"{emoji} <b>{network.upper()}</b>\n"
+        for rank, (entry, _) in enumerate(ranking, start=1):
+            pair = entry['pair']
+            symbol = (pair and pair.base_symbol) or f"{entry['token'][:6]}…"
+            if pair and pair.pair_address:
+                symbol = f"<a href='https://dexscreener.com/{pair.chain_id or network}/{pair.pair_address}'>{symbol}</a>"
+            marker = medals[rank - 1] if rank <= len(medals) else f"{rank}."
+            text += (
+                f"{marker} <b>{symbol}</b> • {format_percentage(pair.change_h24 if pair else None)} • "
+                f"Vol {format_number(pair.volume_h24 if pair else None)}\n"
+            )
+        text += "\n"
+    if not shown:
+        text += "No tokens trending right now. Be the first! 🚀\n\n"
+    text += f"🕒 Updated {format_timestamp(time.time())}"
+    return text
+
+class LeaderboardPublisher:
+    # Keeps one pinned message in LEADERBOARD_CHAT up to date by editing it in place every
+    # LEADERBOARD_INTERVAL seconds (only when the ranking changed). The message id is kept in
+    # the kv table so restarts keep editing the same message.
+    def __init__(self, chat_id, interval=LEADERBOARD_INTERVAL):
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message_id = None
+        self._published_version = None
+        self._task = None
+
+    async def start(self):
+        message_id = await run_db(kv_get, f"leaderboard_message:{self.chat_id}")
+        self.message_id = int(message_id) if message_id else None
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.publish()
+            except Exception as e:
+                print(f"Error publishing leaderboard: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def publish(self, force=False):
+        if not force and leaderboard.version == self._published_version:
+            return
+        version = leaderboard.version
+        text = render_leaderboard()
+        if self.message_id is not None:
+            try:
+                await outbox.edit_message_text(text, self.chat_id, self.message_id, disable_web_page_preview=True)
+                self._published_version = version
+                return
+            except MessageNotModified:
+                self._published_version = version
+                return
+            except MessageToEditNotFound:
+                self.message_id = None
+        message = await outbox.send_message(self.chat_id, text, disable_web_page_preview=True)
+        self.message_id = message.message_id
+        await run_db(kv_set, f"leaderboard_message:{self.chat_id}", self.message_id)
+        try:
+            await outbox.pin_chat_message(self.chat_id, self.message_id, disable_notification=True)
+        except TelegramAPIError as e:
+            print(f"Could not pin leaderboard message: {e}")
+        self._published_version = version
+
+leaderboard_publisher = LeaderboardPublisher(LEADERBOARD_CHAT) if LEADERBOARD_CHAT else None
+
+# ---------------- Market Refresher ----------------
+class MarketRefresher:
+    # Background poller for every tracked token (active campaigns, plus anything else
+    # registered in `sources`). Tokens shared by several campaigns are fetched once per
+    # chain, in DexScreener batches, on a jittered schedule so restarts don't synchronise
+    # with other clients. A 429 stops the current pass and backs off exponentially
+    # (honouring Retry-After); successful passes shrink the backoff again.
+    def __init__(self, interval=REFRESH_INTERVAL, jitter=REFRESH_JITTER):
+        self.interval = interval
+        self.jitter = jitter
+        self.backoff = 0.0
+        self.sources = [leaderboard.tokens]   # callables returning [(network, token), ...]
+        self.before_refresh = []              # async callbacks run before the tracked tokens are collected
+        self.on_refresh = []                  # async callbacks(results) with {(network, token): pair}
+        self.passes = 0
+        self.rate_limited = 0
+        self.last_duration = 0.0
+        self._task = None
+
+    def tracked(self):
+        tokens = {}
+        for source in self.sources:
+            for network, token in source():
+                tokens[(network, normalize_address(token))] = token
+        return tokens
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            delay = self.interval * (1 + random.uniform(-self.jitter, self.jitter)) + self.backoff
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh_once()
+            except Exception as e:
+                print(f"Error refreshing market data: {e}")
+
+    async def refresh_once(self):
+        started = time.monotonic()
+        for callback in self.before_refresh:
+            try:
+                await callback()
+            except Exception as e:
+                print(f"Error in refresh callback {callback.__name__}: {e}")
+        tracked = self.tracked()
+        market_snapshots.retain({token_cache_key(CHAIN_IDS.get(n, n), t) for n, t in tracked})
+        if not tracked:
+            return {}
+        # Chunks are grouped by chain id so a chain-specific provider can take over on failure
+        by_chain = {}
+        for (network, _), token in tracked.items():
+            by_chain.setdefault(CHAIN_IDS.get(network, network), {})[token] = None
+        chunks = []
+        for chain_id, addresses in by_chain.items():
+            addresses = list(addresses)
+            chunks.extend((chain_id, addresses[i:i + DEXSCREENER_BATCH_SIZE]) for i in range(0, len(addresses), DEXSCREENER_BATCH_SIZE))
+        pairs = {chain_id: [] for chain_id in by_chain}
+        limiter = asyncio.Semaphore(REFRESH_CONCURRENCY)
+        limited = []
+
+        async def fetch_chunk(chain_id, chunk):
+            async with limiter:
+                if limited:
+                    return
+                try:
+                    # Failover only: a refresh's latency doesn't reach users, so it isn't hedged
+                    pairs[chain_id].extend(await market_data.fetch_pairs(chunk, chain_id, hedge=False))
+                except RateLimitedError as e:
+                    limited.append(e)
+                except Exception as e:
+                    print(f"Error refreshing token batch: {e}")
+
+        await asyncio.gather(*(fetch_chunk(chain_id, chunk) for chain_id, chunk in chunks))
+        if limited:
+            self.rate_limited += 1
+            self.backoff = min(max(self.backoff * 2, limited[0].retry_after or self.interval), REFRESH_MAX_BACKOFF)
+            print(f"⚠️ Market data rate limit hit, backing off {self.backoff:.0f}s")
+        else:
+            self.backoff = self.backoff / 2 if self.backoff > 1 else 0.0
+
+        results = {}
+        for (network, _), token in tracked.items():
+            chain_id = CHAIN_IDS.get(network, network)
+            pair = select_best_pair(pairs_for_address(pairs[chain_id], token), chain_id)
+            if pair is None:
+                continue
+            results[(network, token)] = pair
+            market_snapshots.put(chain_id, token, pair)
+            token_cache.set(token_cache_key(chain_id, token), pair)
+            leaderboard.update_market(network, token, pair)
+        if shared_token_cache:
+            # Other shards answer lookups of tracked tokens from here instead of the API
+            await shared_token_cache.put_many(
+                (token_cache_key(CHAIN_IDS.get(n, n), t), pair) for (n, t), pair in results.items()
+            )
+        for callback in self.on_refresh:
+            try:
+                await callback(results)
+            except Exception as e:
+                print(f"Error in refresh callback {callback.__name__}: {e}")
+        self.passes += 1
+        self.last_duration = time.monotonic() - started
+        return results
+
+    def stats(self):
+        return {
+            "tracked": len(self.tracked()),
+            "snapshots": len(market_snapshots),
+            "snapshot_hits": market_snapshots.hits,
+            "passes": self.passes,
+            "rate_limited": self.rate_limited,
+            "backoff": self.backoff,
+            "last_duration": self.last_duration,
+        }
+
+market_refresher = MarketRefresher()
+
+# ---------------- Price Alerts ----------------
+# metric -> (emoji, label, PairSnapshot field); the order is the column order of the value matrix
+ALERT_METRICS = {
+    "price": ("💵", "Price", "price_usd"),
+    "change1h": ("📊", "1H change", "change_h1"),
+    "volume": ("📈", "24h volume", "volume_h24"),
+    "liquidity": ("🌊", "Liquidity", "liquidity_usd"),
+}
+ALERT_METRIC_NAMES = list(ALERT_METRICS)
+
+def format_alert_value(metric, value):
+    if metric == "price":
+        return format_price(value)
+    if metric == "change1h":
+        return f"{value:+.2f}%"
+    return format_number(value)
+
+class AlertEngine:
+    # Alert subscriptions live in the `alerts` table and, for evaluation, in parallel numpy
+    # arrays (token row, metric column, direction, threshold, armed) rebuilt only when
+    # subscriptions change. Each refresher tick gathers one value per tracked token and
+    # metric and compares every subscription at once. An alert fires when its condition
+    # becomes true and re-arms only after the condition has cleared again, so a token that
+    # stays above the line notifies once; delivery is rate-limited per user.
+    SWEEP_INTERVAL = 600
+
+    def __init__(self):
+        self.alerts = {}          # id -> alert dict
+        self._dirty = True
+        self._ids = np.empty(0, dtype=np.int64)
+        self._token_keys = []     # row -> (network, normalized token)
+        self._token_index = np.empty(0, dtype=np.int64)
+        self._metric_index = np.empty(0, dtype=np.int64)
+        self._direction = np.empty(0, dtype=np.int8)   # 1 = above, -1 = below
+        self._threshold = np.empty(0, dtype=np.float64)
+        self._armed = np.empty(0, dtype=bool)
+        self._buckets = {}        # user id -> TokenBucket, dropped once full
+        self._last_sweep = time.monotonic()
+        self._deliveries = set()
+        self.fired = 0
+        self.suppressed = 0
+        self.evaluations = 0
+        self.last_duration = 0.0
+
+    @staticmethod
+    def _init_db():
+        db = get_db()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS alerts ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, network TEXT NOT NULL,"
+                " token TEXT NOT NULL, metric TEXT NOT NULL, direction INTEGER NOT NULL, threshold REAL NOT NULL,"
+                " armed INTEGER NOT NULL DEFAULT 1, created_at REAL NOT NULL, fired_at REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS alerts_user ON alerts (user_id)")
+        return fetch_dicts("SELECT * FROM alerts")
+
+    @staticmethod
+    def _insert(alert):
+        db = get_db()
+        with db:
+            cursor = db.execute(
+                "INSERT INTO alerts (user_id, network, token, metric, direction, threshold, armed, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, 1, ?)",
+                (alert['user_id'], alert['network'], alert['token'], alert['metric'],
+                 alert['direction'], alert['threshold'], alert['created_at']),
+            )
+        return cursor.lastrowid
+
+    @staticmethod
+    def _delete(alert_id):
+        db = get_db()
+        with db:
+            db.execute("DELETE FROM alerts WHERE id = ?", (alert_id,))
+
+    @staticmethod
+    def _save_armed(rows):
+        db = get_db()
+        with db:
+            db.executemany("UPDATE alerts SET armed = ?, fired_at = COALESCE(?, fired_at) WHERE id = ?", rows)
+
+    async def load(self):
+        for alert in await run_db(self._init_db):
+            self.alerts[alert['id']] = alert
+        self._dirty = True
+        if self.alerts:
+            print(f"🔔 Restored {len(self.alerts)} price alerts")
+
+    async def add(self, user_id, network, token, metric, direction, threshold):
+        alert = {
+            'user_id': user_id, 'network': network, 'token': token, 'metric': metric,
+            'direction': direction, 'threshold': threshold, 'armed': 1, 'created_at': time.time(), 'fired_at': None,
+        }
+        alert['id'] = await run_db(self._insert, alert)
+        self.alerts[alert['id']] = alert
+        self._dirty = True
+        return alert
+
+    async def remove(self, alert_id, user_id=None):
+        alert = self.alerts.get(alert_id)
+        if alert is None or (user_id is not None and alert['user_id'] != user_id):
+            return None
+        del self.alerts[alert_id]
+        self._dirty = True
+        await run_db(self._delete, alert_id)
+        return alert
+
+    def for_user(self, user_id):
+        return sorted((a for a in self.alerts.values() if a['user_id'] == user_id), key=lambda a: a['id'])
+
+    def tokens(self):
+        # MarketRefresher source: every token with an alert is kept fresh
+        return [(a['network'], a['token']) for a in self.alerts.values()]
 
-# ---------------- Initialize Bot ----------------
-storage = MemoryStorage()
-bot = Bot(token=BOT_TOKEN, parse_mode=types.ParseMode.HTML)
-dp = Dispatcher(bot, storage=storage)
+    def _rebuild(self):
+        alerts = list(self.alerts.values())
+        rows = {}
+        self._ids = np.array([a['id'] for a in alerts], dtype=np.int64)
+        self._token_index = np.array(
+            [rows.setdefault((a['network'], normalize_address(a['token'])), len(rows)) for a in alerts], dtype=np.int64
+        )
+        self._token_keys = list(rows)
+        self._metric_index = np.array([ALERT_METRIC_NAMES.index(a['metric']) for a in alerts], dtype=np.int64)
+        self._direction = np.array([a['direction'] for a in alerts], dtype=np.int8)
+        self._threshold = np.array([a['threshold'] for a in alerts], dtype=np.float64)
+        self._armed = np.array([bool(a['armed']) for a in alerts], dtype=bool)
+        self._dirty = False
 
-# ---------------- States ----------------
-class UserState(StatesGroup):
-    waiting_for_ca = State()
-    waiting_for_trend_package = State()
-    waiting_for_payment = State()
-    trending_active = State()
+    def _values(self, pairs):
+        # One row per token, one column per metric; NaN where this pass has no data
+        values = np.full((len(self._token_keys), len(ALERT_METRIC_NAMES)), np.nan)
+        fields = [ALERT_METRICS[m][2] for m in ALERT_METRIC_NAMES]
+        for row, key in enumerate(self._token_keys):
+            pair = pairs.get(key)
+            if pair is not None:
+                values[row] = [np.nan if v is None else v for v in (getattr(pair, f) for f in fields)]
+        return values
 
-# ---------------- Utils ----------------
-async def fetch_token_info(chain_id: str, token_address: str):
-    url = f"https://api.dexscreener.com/latest/dex/tokens/{token_address}"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data and 'pairs' in data and len(data['pairs']) > 0:
-                        chain_pairs = [p for p in data['pairs'] if p.get('chainId','').lower() == chain_id.lower()]
-                        if chain_pairs:
-                            pair = max(chain_pairs, key=lambda x: float(x.get('liquidity', {}).get('usd',0) or 0))
-                            return pair
-                        elif data['pairs']:
-                            return data['pairs'][0]
-    except Exception as e:
-        print(f"Error fetching token info: {e}")
-    return None
+    async def sync(self):
+        # Sharded mode: alerts are added and removed on each user's shard, so the leader
+        # re-reads the table; armed flags are only ever written here, so nothing is lost
+        alerts = {a['id']: a for a in await run_db(fetch_dicts, "SELECT * FROM alerts")}
+        if alerts.keys() != self.alerts.keys():
+            self._dirty = True
+        self.alerts = alerts
 
-def format_number(num):
-    try:
-        num = float(num)
-        if num >= 1_000_000_000:
-            return f"${num/1_000_000_000:.2f}B"
-        elif num >= 1_000_000:
-            return f"${num/1_000_000:.2f}M"
-        elif num >= 1_000:
-            return f"${num/1_000:.2f}K"
-        else:
-            return f"${num:.2f}"
-    except:
-        return "N/A"
+    async def evaluate(self, results):
+        # MarketRefresher on_refresh hook: results maps (network, token) -> PairSnapshot
+        if not self.alerts:
+            return []
+        if self._dirty:
+            self._rebuild()
+        started = time.perf_counter()
+        pairs = {(network, normalize_address(token)): pair for (network, token), pair in results.items()}
+        current = self._values(pairs)[self._token_index, self._metric_index]
+        known = ~np.isnan(current)
+        with np.errstate(invalid="ignore"):
+            hit = np.where(self._direction > 0, current >= self._threshold, current <= self._threshold)
+        fire = hit & self._armed
+        armed = (self._armed & ~fire) | (known & ~hit)
+        changed = np.flatnonzero(armed != self._armed)
+        self._armed = armed
+        self.evaluations += 1
+        self.last_duration = time.perf_counter() - started
 
-def format_percentage(num):
-    try:
-        num = float(num)
-        if num > 0: return f"🟢 +{num:.2f}%"
-        elif num < 0: return f"🔴 {num:.2f}%"
-        else: return f"⚪ {num:.2f}%"
-    except:
-        return "⚪ N/A"
+        now = time.time()
+        fired = set(np.flatnonzero(fire).tolist())
+        rows = []
+        for i in changed.tolist():
+            alert = self.alerts.get(int(self._ids[i]))
+            if alert is not None:
+                alert['armed'] = int(armed[i])
+                rows.append((int(armed[i]), now if i in fired else None, alert['id']))
+        if rows:
+            await run_db(self._save_armed, rows)
 
-async def resize_image(url, size=(300,300)):
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                img_bytes = await resp.read()
-                img = Image.open(BytesIO(img_bytes))
-                
-                # Convert to RGB if necessary
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    if img.mode in ('RGBA', 'LA'):
-                        background.paste(img, mask=img.split()[-1])
-                    else:
-                        background.paste(img)
-                    img = background
-                
-                # Create square canvas with padding
-                max_dim = max(img.size)
-                square_img = Image.new('RGB', (max_dim, max_dim), (255, 255, 255))
-                offset = ((max_dim - img.size[0]) // 2, (max_dim - img.size[1]) // 2)
-                square_img.paste(img, offset)
-                
-                # Resize to target size
-                square_img.thumbnail(size, Image.Resampling.LANCZOS)
-                
-                bio = BytesIO()
-                bio.name = "logo.png"
-                square_img.save(bio, format="PNG", quality=95)
-                bio.seek(0)
-                return bio
-    except Exception as e:
-        print(f"Error resizing image: {e}")
-        return None
+        if time.monotonic() - self._last_sweep >= self.SWEEP_INTERVAL:
+            self._last_sweep = time.monotonic()
+            drop_full_buckets(self._buckets)
+        deliveries = []
+        for i in sorted(fired):
+            alert = self.alerts.get(int(self._ids[i]))
+            if alert is None:
+                continue
+            bucket = self._buckets.get(alert['user_id'])
+            if bucket is None:
+                bucket = self._buckets[alert['user_id']] = TokenBucket(ALERT_RATE_PER_HOUR / 3600, ALERT_BURST)
+            if bucket.delay() > 0:
+                self.suppressed += 1
+                continue
+            bucket.consume()
+            self.fired += 1
+            key = self._token_keys[self._token_index[i]]
+            deliveries.append((alert, float(current[i]), pairs.get(key)))
+        if deliveries:
+            # Sent in the background so a large batch never holds up the refresher
+            task = asyncio.create_task(self._deliver(deliveries))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        return deliveries
 
-def create_professional_message(pair_data, chain_name):
-    if not pair_data:
-        return None, None, None
-    base_token = pair_data.get('baseToken',{})
-    price_usd = pair_data.get('priceUsd','N/A')
-    price_change_h24 = pair_data.get('priceChange',{}).get('h24',0)
-    price_change_h6 = pair_data.get('priceChange',{}).get('h6',0)
-    price_change_h1 = pair_data.get('priceChange',{}).get('h1',0)
-    volume_24h = pair_data.get('volume',{}).get('h24',0)
-    liquidity = pair_data.get('liquidity',{}).get('usd',0)
-    fdv = pair_data.get('fdv',0)
-    market_cap = pair_data.get('marketCap',0)
-    pair_chain = pair_data.get('chainId','Unknown')
-    dex_name = pair_data.get('dexId','Unknown')
-    pair_address = pair_data.get('pairAddress','')
-    logo_url = pair_data.get('info',{}).get('imageUrl') or base_token.get('imageUrl')
-
-    # Price formatting
-    try:
-        price_float = float(price_usd)
-        if price_float < 0.000001: price_display = f"${price_float:.10f}"
-        elif price_float < 0.01: price_display = f"${price_float:.8f}"
-        else: price_display = f"${price_float:.6f}"
-    except: price_display = "N/A"
+    async def _deliver(self, deliveries):
+        await asyncio.gather(*(self._notify(*delivery) for delivery in deliveries), return_exceptions=True)
 
-    network_emoji = NETWORK_EMOJIS.get(pair_chain.lower(),"🔗")
+    async def _notify(self, alert, value, pair):
+        emoji, label, _ = ALERT_METRICS[alert['metric']]
+        network = alert['network']
+        symbol = (pair and pair.base_symbol) or f"{alert['token'][:6]}…"
+        text = (
+            f"🔔 <b>ALERT #{alert['id']}</b>\n\n"
+            f"{NETWORK_EMOJIS.get(network, '🔗')} <b>{symbol}</b> on {network.upper()}\n"
+            f"{emoji} {label} is now <b>{format_alert_value(alert['metric'], value)}</b> "
+            f"({'above' if alert['direction'] > 0 else 'below'} {format_alert_value(alert['metric'], alert['threshold'])})\n\n"
+            f"<code>{alert['token']}</code>"
+        )
+        buttons = []
+        if pair and pair.pair_address:
+            buttons.append([InlineKeyboardButton("📊 View Live Chart", url=f"https://dexscreener.com/{pair.chain_id or network}/{pair.pair_address}")])
+        buttons.append([InlineKeyboardButton("🗑 Remove Alert", callback_data=f"alertdel_{alert['id']}")])
+        try:
+            await outbox.send_message(alert['user_id'], text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+                                      disable_web_page_preview=True)
+        except Exception as e:
+            print(f"Could not deliver alert #{alert['id']}: {e}")
 
-    message = (
-        f"╔══════════════════════════╗\n"
-        f"     <b>🎯 TOKEN ANALYTICS</b>\n"
-        f"╚══════════════════════════╝\n\n"
-        f"{network_emoji} <b>{base_token.get('symbol','Unknown')}</b> • {base_token.get('name','Unknown')}\n"
-        f"🏦 <b>DEX:</b> {dex_name.upper()}\n"
-        f"⛓️ <b>Chain:</b> {pair_chain.upper()}\n\n"
-        f"┏━━━━━━━━━━━━━━━━━━━━━━━━┓\n"
-        f"┃  <b>💰 PRICE INFORMATION</b>   ┃\n"
-        f"┗━━━━━━━━━━━━━━━━━━━━━━━━┛\n"
-        f"💵 <b>Current Price:</b> {price_display}\n\n"
-        f"📊 <b>Price Changes:</b>\n"
-        f"  • 1H:  {format_percentage(price_change_h1)}\n"
-        f"  • 6H:  {format_percentage(price_change_h6)}\n"
-        f"  • 24H: {format_percentage(price_change_h24)}\n\n"
-        f"┏━━━━━━━━━━━━━━━━━━━━━━━━┓\n"
-        f"┃  <b>📈 MARKET STATISTICS</b>   ┃\n"
-        f"┗━━━━━━━━━━━━━━━━━━━━━━━━┛\n"
-        f"💎 <b>Market Cap:</b> {format_number(market_cap)}\n"
-        f"🌊 <b>Liquidity:</b> {format_number(liquidity)}\n"
-        f"📊 <b>24h Volume:</b> {format_number(volume_24h)}\n"
-        f"💹 <b>FDV:</b> {format_number(fdv)}\n\n"
-        f"┏━━━━━━━━━━━━━━━━━━━━━━━━┓\n"
-        f"┃  <b>📝 CONTRACT INFO</b>       ┃\n"
-        f"┗━━━━━━━━━━━━━━━━━━━━━━━━┛\n"
-        f"<code>{base_token.get('address','N/A')}</code>\n"
-    )
-    chart_url = f"https://dexscreener.com/{pair_chain}/{pair_address}" if pair_address else None
-    return logo_url, message, chart_url
+    def stats(self):
+        return {
+            "alerts": len(self.alerts),
+            "users": len({a['user_id'] for a in self.alerts.values()}),
+            "fired": self.fired,
+            "suppressed": self.suppressed,
+            "evaluations": self.evaluations,
+            "last_duration": self.last_duration,
+        }
+
+alert_engine = AlertEngine()
+market_refresher.sources.append(alert_engine.tokens)
+market_refresher.on_refresh.append(alert_engine.evaluate)
+if SHARDS > 1:
+    # Alerts added on other shards are picked up before the pass collects its tokens
+    market_refresher.before_refresh.append(alert_engine.sync)
+
+# ---------------- Payment Watcher ----------------
+async def rpc_batch(url, calls):
+    # One JSON-RPC batch request; returns results in call order and raises on any error
+    payload = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params} for i, (method, params) in enumerate(calls)]
+    async with get_http_session().post(url, json=payload) as response:
+        if response.status == 429:
+            raise RateLimitedError(response.headers.get("Retry-After"))
+        if response.status != 200:
+            raise ValueError(f"RPC returned HTTP {response.status}")
+        data = await response.json(content_type=None)
+    if isinstance(data, dict):
+        raise ValueError(f"RPC batch rejected: {data.get('error')}")
+    by_id = {item.get("id"): item for item in data}
+    results = []
+    for i, (method, _) in enumerate(calls):
+        item = by_id.get(i) or {}
+        if item.get("error"):
+            raise ValueError(f"RPC error in {method}: {item['error']}")
+        results.append(item.get("result"))
+    return results
+
+def _lamports_received(tx, wallet):
+    if not tx or not tx.get("meta") or tx["meta"].get("err") is not None:
+        return 0
+    keys = tx["transaction"]["message"]["accountKeys"]
+    keys = [k["pubkey"] if isinstance(k, dict) else k for k in keys]
+    if wallet not in keys:
+        return 0
+    i = keys.index(wallet)
+    return tx["meta"]["postBalances"][i] - tx["meta"]["preBalances"][i]
+
+class PaymentWatcher:
+    # Watches each wallet in PAYMENT_WALLETS that has a PAYMENT_RPC_<NETWORK> endpoint and
+    # activates orders whose payment lands on-chain. EVM chains are scanned block by block
+    # (batched eth_getBlockByNumber from a persisted block cursor, PAYMENT_CONFIRMATIONS
+    # behind head); Solana uses getSignaturesForAddress from a persisted signature cursor
+    # plus batched getTransaction. Transfers are matched to pending orders by memo
+    # (OT<order id>, Solana) or by the order's unique amount.
+    def __init__(self, rpc_urls=PAYMENT_RPC_URLS):
+        self.rpc_urls = rpc_urls
+        self.matched = 0
+        self.unmatched = 0
+        self.errors = 0
+        self._tasks = []
+
+    async def start(self):
+        for network, url in self.rpc_urls.items():
+            if PAYMENT_WALLETS.get(network):
+                self._tasks.append(asyncio.create_task(self._run(network, url, PAYMENT_WALLETS[network])))
+        if self._tasks:
+            print(f"🤖 Watching payments on {', '.join(self.rpc_urls)}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self, network, url, wallet):
+        while True:
+            try:
+                if network == "solana":
+                    await self.poll_solana(network, url, wallet)
+                else:
+                    await self.poll_evm(network, url, wallet)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error polling {network} payments: {e}")
+            await asyncio.sleep(PAYMENT_POLL_INTERVAL)
+
+    async def poll_evm(self, network, url, wallet):
+        cursor_key = f"payment_cursor:{network}"
+        (head,) = await rpc_batch(url, [("eth_blockNumber", [])])
+        safe = int(head, 16) - PAYMENT_CONFIRMATIONS
+        cursor = await run_db(kv_get, cursor_key)
+        if cursor is None:
+            # First run starts at the chain tip rather than replaying history
+            await run_db(kv_set, cursor_key, safe)
+            return
+        cursor = int(cursor)
+        if safe <= cursor:
+            return
+        last = min(safe, cursor + PAYMENT_MAX_BLOCKS)
+        wallet = wallet.lower()
+        candidates = []
+        numbers = list(range(cursor + 1, last + 1))
+        for i in range(0, len(numbers), PAYMENT_BATCH_SIZE):
+            calls = [("eth_getBlockByNumber", [hex(n), True]) for n in numbers[i:i + PAYMENT_BATCH_SIZE]]
+            for block in await rpc_batch(url, calls):
+                for tx in (block or {}).get("transactions", []):
+                    if (tx.get("to") or "").lower() == wallet and int(tx.get("value", "0x0"), 16) > 0:
+                        candidates.append(tx)
+        transfers = []
+        for i in range(0, len(candidates), PAYMENT_BATCH_SIZE):
+            chunk = candidates[i:i + PAYMENT_BATCH_SIZE]
+            receipts = await rpc_batch(url, [("eth_getTransactionReceipt", [tx["hash"]]) for tx in chunk])
+            for tx, receipt in zip(chunk, receipts):
+                if receipt and receipt.get("status") == "0x1":
+                    transfers.append((tx["hash"], int(tx["value"], 16), None))
+        await self.match(network, transfers)
+        await run_db(kv_set, cursor_key, last)
+
+    async def poll_solana(self, network, url, wallet):
+        cursor_key = f"payment_cursor:{network}"
+        # None before the first poll; "" once polled while the wallet had no signatures yet
+        until = await run_db(kv_get, cursor_key)
+        first_run = until is None
+        signatures = []
+        before = None
+        while True:
+            options = {"limit": 100, "commitment": "confirmed"}
+            if until:
+                options["until"] = until
+            if before:
+                options["before"] = before
+            (page,) = await rpc_batch(url, [("getSignaturesForAddress", [wallet, options])])
+            page = page or []
+            signatures.extend(page)
+            # First run only needs the newest signature to start from
+            if first_run or len(page) < 100:
+                break
+            before = page[-1]["signature"]
+        if not signatures:
+            if first_run:
+                await run_db(kv_set, cursor_key, "")
+            return
+        if not first_run:
+            ok = [sig for sig in signatures if sig.get("err") is None]
+            transfers = []
+            options = {"encoding": "json", "commitment": "confirmed", "maxSupportedTransactionVersion": 0}
+            for i in range(0, len(ok), PAYMENT_BATCH_SIZE):
+                chunk = ok[i:i + PAYMENT_BATCH_SIZE]
+                txs = await rpc_batch(url, [("getTransaction", [sig["signature"], options]) for sig in chunk])
+                for sig, tx in zip(chunk, txs):
+                    received = _lamports_received(tx, wallet)
+                    if received > 0:
+                        transfers.append((sig["signature"], received, sig.get("memo")))
+            await self.match(network, transfers)
+        await run_db(kv_set, cursor_key, signatures[0]["signature"])
+
+    async def match(self, network, transfers):
+        if not transfers:
+            return
+        decimals = NATIVE_DECIMALS.get(network, 18)
+        pending = await campaign_scheduler.pending_orders(network, time.time() - PAYMENT_ORDER_TTL)
+        by_id = {c['id']: c for c in pending}
+        by_amount = {round(c['amount'], 6): c for c in pending}  # newest order wins a shared amount
+        for tx_hash, units, memo in transfers:
+            amount = round(units / 10 ** decimals, 6)
+            reference = re.search(r"OT-?(\d+)", memo or "")
+            campaign = by_id.get(int(reference.group(1))) if reference else None
+            if campaign is not None and amount + 1e-9 < campaign['amount']:
+                campaign = None
+            if campaign is None:
+                campaign = by_amount.get(amount)
+            if campaign is None:
+                self.unmatched += 1
+                print(f"Unmatched {network} payment {tx_hash}: {amount}")
+                # Usually a wrong amount; support can match it to the order by hand
+                await self.notify_support(
+                    f"⚠️ <b>UNMATCHED PAYMENT</b>\n"
+                    f"{NETWORK_EMOJIS.get(network, '🔗')} {network.upper()} • {amount} {network.upper()}\n"
+                    + (f"📝 Memo: <code>{quote_html(memo)}</code>\n" if memo else "")
+                    + f"🧾 <code>{tx_hash}</code>"
+                )
+                continue
+            by_id.pop(campaign['id'], None)
+            by_amount.pop(round(campaign['amount'], 6), None)
+            if await activate_campaign(campaign['id'], tx_hash=tx_hash, actor="watcher") is None:
+                continue
+            self.matched += 1
+            await self.notify_support(
+                f"🤖 <b>AUTO-ACTIVATED</b> campaign #{campaign['id']}\n"
+                f"{NETWORK_EMOJIS.get(network, '🔗')} {network.upper()} • {campaign['package'].upper()} • "
+                f"{amount} {network.upper()}\n"
+                f"👤 <code>{campaign['user_id']}</code>\n"
+                f"🧾 <code>{tx_hash}</code>"
+            )
+
+    @staticmethod
+    async def notify_support(text):
+        if not SUPPORT_CHAT:
+            return
+        try:
+            await outbox.send_message(SUPPORT_CHAT, text)
+        except Exception as e:
+            print(f"Could not send notification to support chat: {e}")
+
+payment_watcher = PaymentWatcher()
+
+# ---------------- Config Watcher ----------------
+class ConfigWatcher:
+    # Polls CONFIG_PATH for changes; a new version is validated in full and only then
+    # swapped in, so a bad edit is reported and the running config stays in place.
+    def __init__(self, path=CONFIG_PATH, interval=CONFIG_POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.version = 1
+        self.loaded_at = time.time()
+        self.last_error = None
+        self.on_change = []  # async callbacks(old_tables, new_tables)
+        self._stamp = self._file_stamp()
+        self._task = None
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except (OSError, TypeError):
+            return None
+
+    async def start(self):
+        if self.path:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            stamp = self._file_stamp()
+            if stamp is None or stamp == self._stamp:
+                continue
+            self._stamp = stamp
+            await self.reload()
+
+    async def reload(self):
+        try:
+            tables = await asyncio.get_running_loop().run_in_executor(None, read_config_file, self.path)
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+            print(f"⚠️ Network config change rejected, keeping version {self.version}: {e}")
+            return False
+        old = {"wallets": PAYMENT_WALLETS, "packages": TRENDING_PACKAGES, "chain_ids": CHAIN_IDS,
+               "emojis": NETWORK_EMOJIS, "labels": NETWORK_LABELS}
+        apply_network_config(tables)
+        self.version += 1
+        self.loaded_at = time.time()
+        self.last_error = None
+        print(f"🔄 Network config v{self.version} loaded: {', '.join(CHAIN_IDS)}")
+        for callback in self.on_change:
+            try:
+                await callback(old, tables)
+            except Exception as e:
+                print(f"Error in config callback {callback.__name__}: {e}")
+        return True
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "path": self.path,
+            "networks": len(CHAIN_IDS),
+            "loaded_at": self.loaded_at,
+            "last_error": self.last_error,
+        }
+
+config_watcher = ConfigWatcher()
+
+async def restart_payment_watcher(old, new):
+    # Watcher tasks hold their wallet address; cursors are persisted so a restart loses nothing
+    if IS_LEADER and old["wallets"] != new["wallets"]:
+        await payment_watcher.stop()
+        await payment_watcher.start()
+
+config_watcher.on_change.append(restart_payment_watcher)
+
+def network_menu_rows():
+    return [
+        [InlineKeyboardButton(f"{NETWORK_EMOJIS.get(n,'🔗')} {NETWORK_LABELS.get(n, n.title())}", callback_data=f"select_{n}")]
+        for n in CHAIN_IDS
+    ]
+
+def network_summary():
+    labels = [f"{NETWORK_EMOJIS.get(n,'🔗')} {NETWORK_LABELS.get(n, n.title())}" for n in CHAIN_IDS]
+    return "\n".join("  |  ".join(labels[i:i + 3]) for i in range(0, len(labels), 3))
 
 # ---------------- Start Command ----------------
 @dp.message_handler(commands=['start'], state='*')
@@ -212,31 +3294,29 @@ async def start_command(message: types.Message, state: FSMContext):
         f"👋 Welcome, <b>{user_first}</b>!\n\n"
         f"Your professional multi-chain DEX analytics platform.\n\n"
         f"<b>📊 Track & Trend Across:</b>\n"
-        f"💜 Solana  |  💠 Ethereum  |  🟡 BSC\n"
-        f"🧊 Base  |  ⚪ Arbitrum\n\n"
+        f"{network_summary()}\n\n"
         f"Select a network below to get started! 👇"
     )
-    buttons = [
-        [InlineKeyboardButton("💜 Solana", callback_data="select_solana")],
-        [InlineKeyboardButton("💠 Ethereum", callback_data="select_ethereum")],
-        [InlineKeyboardButton("🟡 BSC", callback_data="select_bsc")],
-        [InlineKeyboardButton("🧊 Base", callback_data="select_base")],
-        [InlineKeyboardButton("⚪ Arbitrum", callback_data="select_arbitrum")],
+    buttons = network_menu_rows() + [
         [InlineKeyboardButton("💰 Prices", callback_data="show_prices")],
         [InlineKeyboardButton("🛠️ Support", callback_data="support")]
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer(start_text, reply_markup=keyboard)
+    await outbox.answer(message, start_text, reply_markup=keyboard)
 
 # ---------------- Network Selection ----------------
 @dp.callback_query_handler(lambda c: c.data.startswith("select_"), state='*')
 async def handle_network_selection(callback_query: types.CallbackQuery, state: FSMContext):
-    await callback_query.answer()
     network = callback_query.data.split("_")[1]
+    if network not in CHAIN_IDS:
+        # A menu sent before the network was removed from the config
+        await callback_query.answer("This network is no longer available.", show_alert=True)
+        return
+    await callback_query.answer()
     await state.update_data(selected_network=network)
     await UserState.waiting_for_ca.set()
     network_emoji = NETWORK_EMOJIS.get(network,"🔗")
-    await callback_query.message.answer(
+    await outbox.answer(callback_query.message,
         f"✅ <b>{network_emoji} {network.upper()} Network Selected</b>\n\n"
         f"Please send the <b>Contract Address (CA)</b> of the token you want to analyze."
     )
@@ -248,7 +3328,12 @@ async def handle_contract_address(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     network = user_data.get('selected_network','ethereum')
 
-    waiting_msg = await message.answer(f"🔍 <b>Analyzing Token Data...</b>\n<code>{ca}</code>\n⏳ Fetching real-time data...")
+    addresses = parse_contract_addresses(ca)
+    if len(addresses) > 1:
+        await handle_multiple_contract_addresses(message, network, addresses)
+        return
+
+    waiting_msg = await outbox.answer(message, f"🔍 <b>Analyzing Token Data...</b>\n<code>{ca}</code>\n⏳ Fetching real-time data...")
 
     try:
         chain_id = CHAIN_IDS.get(network, network)
@@ -256,33 +3341,319 @@ async def handle_contract_address(message: types.Message, state: FSMContext):
         logo_url, token_info, chart_url = create_professional_message(pair_data, network)
 
         if not token_info:
-            await waiting_msg.edit_text("❌ <b>Unable to fetch token info.</b>")
+            await outbox.edit(waiting_msg, "❌ <b>Unable to fetch token info.</b>")
             return
 
         buttons = []
         if chart_url:
             buttons.append([InlineKeyboardButton("📊 View Live Chart", url=chart_url)])
         buttons.append([InlineKeyboardButton("🚀 Start Trending", callback_data="start_trending")])
+        alert_data = f"alert_{network}_{ca}"
+        if len(alert_data.encode()) <= 64:  # Telegram's callback data limit
+            buttons.append([InlineKeyboardButton("🔔 Set Price Alert", callback_data=alert_data)])
         buttons.append([InlineKeyboardButton("🔄 Analyze Another", callback_data=f"select_{network}")])
         buttons.append([InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"),
                         InlineKeyboardButton("💬 Support", callback_data="support")])
         keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
         if logo_url:
-            img = await resize_image(logo_url)
-            if img:
-                await waiting_msg.delete()
-                await message.answer_photo(photo=img, caption=token_info, reply_markup=keyboard)
+            logo = await load_logo(logo_url)
+            if logo:
+                await outbox.delete(waiting_msg)
+                await answer_logo_photo(message, logo_url, logo, caption=token_info, reply_markup=keyboard)
             else:
-                await waiting_msg.edit_text(token_info, reply_markup=keyboard)
+                await outbox.edit(waiting_msg, token_info, reply_markup=keyboard)
         else:
-            await waiting_msg.edit_text(token_info, reply_markup=keyboard)
+            await outbox.edit(waiting_msg, token_info, reply_markup=keyboard)
 
         await state.update_data(contract_address=ca)
         await UserState.waiting_for_trend_package.set()
 
     except Exception as e:
-        await waiting_msg.edit_text(f"❌ Error fetching token info: {e}")
+        await outbox.edit(waiting_msg, f"❌ Error fetching token info: {e}")
+
+async def handle_multiple_contract_addresses(message: types.Message, network, addresses):
+    # Multi-CA mode: one batched lookup, compact summaries, and the user stays in
+    # waiting_for_ca so another list (or a single CA for trending) can follow.
+    skipped = addresses[MAX_CAS_PER_MESSAGE:]
+    addresses = addresses[:MAX_CAS_PER_MESSAGE]
+    waiting_msg = await outbox.answer(message, f"🔍 <b>Analyzing {len(addresses)} Tokens...</b>\n⏳ Fetching real-time data...")
+
+    try:
+        chain_id = CHAIN_IDS.get(network, network)
+        results = await fetch_tokens_info(chain_id, addresses)
+        found = sum(1 for pair in results.values() if pair)
+
+        header = (
+            f"╔══════════════════════════╗\n"
+            f"     <b>🎯 MULTI-TOKEN ANALYTICS</b>\n"
+            f"╚══════════════════════════╝\n\n"
+            f"{NETWORK_EMOJIS.get(network,'🔗')} <b>{network.upper()}</b> • {found}/{len(addresses)} found\n\n"
+        )
+        chunks = [header]
+        for address in addresses:
+            line = create_compact_line(results.get(address), address) + "\n\n"
+            if len(chunks[-1]) + len(line) > 4000:
+                chunks.append("")
+            chunks[-1] += line
+        if skipped:
+            chunks[-1] += f"⚠️ Only the first {MAX_CAS_PER_MESSAGE} addresses were analyzed ({len(skipped)} skipped)."
+
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"),
+             InlineKeyboardButton("💬 Support", callback_data="support")]
+        ])
+        await outbox.edit(waiting_msg, chunks[0], reply_markup=keyboard if len(chunks) == 1 else None,
+                                    disable_web_page_preview=True)
+        for i, chunk in enumerate(chunks[1:], start=2):
+            await outbox.answer(message, chunk, reply_markup=keyboard if i == len(chunks) else None,
+                                 disable_web_page_preview=True)
+
+    except Exception as e:
+        await outbox.edit(waiting_msg, f"❌ Error fetching token info: {e}")
+
+# ---------------- Price Alert Handlers ----------------
+ALERT_THRESHOLD = re.compile(r"(>|<|above|below)?\s*\$?\s*([-+]?(?:\d[\d,]*(?:\.\d*)?|\.\d+))\s*([kmb%])?", re.I)
+ALERT_MULTIPLIERS = {"k": 1e3, "m": 1e6, "b": 1e9}
+
+def parse_alert_threshold(text):
+    # "> 0.002", "below 1.5m", "-10%", "250k" -> (direction or None, value) or None
+    match = ALERT_THRESHOLD.fullmatch((text or "").strip())
+    if not match:
+        return None
+    op, number, suffix = match.groups()
+    try:
+        value = float(number.replace(",", ""))
+    except ValueError:
+        return None
+    value *= ALERT_MULTIPLIERS.get((suffix or "").lower(), 1)
+    direction = None
+    if op:
+        direction = 1 if op.lower() in (">", "above") else -1
+    return direction, value
+
+def current_alert_value(pair, metric):
+    return getattr(pair, ALERT_METRICS[metric][2]) if pair else None
+
+@dp.callback_query_handler(lambda c: c.data.startswith("alert_"), state='*')
+async def handle_alert_start(callback_query: types.CallbackQuery, state: FSMContext):
+    _, network, token = callback_query.data.split("_", 2)
+    if network not in CHAIN_IDS:
+        await callback_query.answer("This network is no longer available.", show_alert=True)
+        return
+    if len(alert_engine.for_user(callback_query.from_user.id)) >= ALERT_MAX_PER_USER:
+        await callback_query.answer(f"You already have {ALERT_MAX_PER_USER} alerts. Remove one with /alerts first.", show_alert=True)
+        return
+    await callback_query.answer()
+    # Remember where the user was so the token card's other buttons keep working afterwards
+    await state.update_data(alert_network=network, alert_token=token, alert_return_state=await state.get_state())
+    await UserState.waiting_for_alert_metric.set()
+    buttons = [
+        [InlineKeyboardButton(f"{emoji} {label}", callback_data=f"alertm_{metric}")]
+        for metric, (emoji, label, _) in ALERT_METRICS.items()
+    ]
+    await outbox.answer(callback_query.message,
+        f"🔔 <b>New Price Alert</b>\n\n<code>{token}</code>\n\nWhat should we watch?",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
+    )
+
+@dp.callback_query_handler(lambda c: c.data.startswith("alertm_"), state=UserState.waiting_for_alert_metric)
+async def handle_alert_metric(callback_query: types.CallbackQuery, state: FSMContext):
+    metric = callback_query.data.split("_", 1)[1]
+    if metric not in ALERT_METRICS:
+        await callback_query.answer()
+        return
+    await callback_query.answer()
+    user_data = await state.get_data()
+    network = user_data.get("alert_network")
+    pair = await fetch_token_info(CHAIN_IDS.get(network, network), user_data.get("alert_token", ""))
+    value = current_alert_value(pair, metric)
+    await state.update_data(alert_metric=metric)
+    await UserState.waiting_for_alert_threshold.set()
+    emoji, label, _ = ALERT_METRICS[metric]
+    now_line = f"Now: <b>{format_alert_value(metric, value)}</b>\n\n" if value is not None else ""
+    await outbox.answer(callback_query.message,
+        f"{emoji} <b>{label} alert</b>\n{now_line}"
+        f"Send the threshold, e.g. <code>&gt; 0.002</code>, <code>below 250k</code> or <code>-10%</code>. "
+        f"Without &gt; or &lt; the alert fires when the value crosses it from where it is now."
+    )
+
+@dp.message_handler(state=UserState.waiting_for_alert_threshold)
+async def handle_alert_threshold(message: types.Message, state: FSMContext):
+    parsed = parse_alert_threshold(message.text)
+    if parsed is None:
+        await outbox.answer(message, "❌ Please send a number, e.g. <code>&gt; 0.002</code> or <code>below 1.5m</code>.")
+        return
+    direction, threshold = parsed
+    user_data = await state.get_data()
+    network = user_data.get("alert_network")
+    token = user_data.get("alert_token")
+    metric = user_data.get("alert_metric")
+    if not network or not token or metric not in ALERT_METRICS:
+        await state.finish()
+        await outbox.answer(message, "❌ That alert setup expired. Open the token card and tap <b>Set Price Alert</b> again.")
+        return
+    if direction is None:
+        pair = await fetch_token_info(CHAIN_IDS.get(network, network), token)
+        value = current_alert_value(pair, metric)
+        direction = -1 if value is not None and threshold < value else 1
+    alert = await alert_engine.add(message.from_user.id, network, token, metric, direction, threshold)
+    await state.set_state(user_data.get("alert_return_state"))
+    emoji, label, _ = ALERT_METRICS[metric]
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton("📋 My Alerts", callback_data="alerts_list")],
+        [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")],
+    ])
+    await outbox.answer(message,
+        f"✅ <b>Alert #{alert['id']} set</b>\n\n"
+        f"{NETWORK_EMOJIS.get(network, '🔗')} {network.upper()} • <code>{token}</code>\n"
+        f"{emoji} {label} {'above' if direction > 0 else 'below'} <b>{format_alert_value(metric, threshold)}</b>\n\n"
+        f"Checked every {REFRESH_INTERVAL:g}s.",
+        reply_markup=keyboard
+    )
+
+def render_alert_list(user_id):
+    alerts = alert_engine.for_user(user_id)
+    if not alerts:
+        return "🔕 You have no price alerts. Open a token card and tap <b>Set Price Alert</b>.", None
+    lines = ["🔔 <b>Your Price Alerts</b>\n"]
+    buttons = []
+    for alert in alerts:
+        emoji, label, _ = ALERT_METRICS[alert['metric']]
+        lines.append(
+            f"#{alert['id']} {NETWORK_EMOJIS.get(alert['network'], '🔗')} <code>{alert['token']}</code>\n"
+            f"   {emoji} {label} {'above' if alert['direction'] > 0 else 'below'} "
+            f"{format_alert_value(alert['metric'], alert['threshold'])}"
+        )
+        buttons.append([InlineKeyboardButton(f"🗑 Remove #{alert['id']}", callback_data=f"alertdel_{alert['id']}")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@dp.message_handler(commands=['alerts'], state='*')
+async def alerts_command(message: types.Message):
+    text, keyboard = render_alert_list(message.from_user.id)
+    await outbox.answer(message, text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data == "alerts_list", state='*')
+async def handle_alerts_list(callback_query: types.CallbackQuery):
+    await callback_query.answer()
+    text, keyboard = render_alert_list(callback_query.from_user.id)
+    await outbox.answer(callback_query.message, text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("alertdel_"), state='*')
+async def handle_alert_remove(callback_query: types.CallbackQuery):
+    try:
+        alert_id = int(callback_query.data.split("_", 1)[1])
+    except ValueError:
+        await callback_query.answer()
+        return
+    alert = await alert_engine.remove(alert_id, callback_query.from_user.id)
+    await callback_query.answer(f"Alert #{alert_id} removed." if alert else "That alert is already gone.")
+    text, keyboard = render_alert_list(callback_query.from_user.id)
+    await outbox.answer(callback_query.message, text, reply_markup=keyboard)
+
+# ---------------- Inline Mode ----------------
+# `@bot <CA>` in any chat: one DexScreener lookup, one card per network the token trades on
+# (per-network lookups if DexScreener fails).
+# Each new query from a user cancels their previous one, and nothing is fetched until the
+# query has been stable for INLINE_DEBOUNCE seconds.
+ADDRESS_PATTERN = re.compile(r"0x[0-9a-fA-F]{40}|[1-9A-HJ-NP-Za-km-z]{32,44}")
+inline_lookups = {}  # user id -> running lookup task
+
+async def fetch_token_info_all_chains(token_address: str):
+    # {network: best pair} for every network in CHAIN_IDS, from a single request. Only
+    # DexScreener serves chain-agnostic lookups, so that request can't be hedged; if it
+    # fails, each network is looked up on its own through the hedged per-chain path.
+    key = ("*", normalize_address(token_address))
+    try:
+        pairs = await token_cache.get_or_load(key, lambda: market_data.fetch_pairs([token_address]))
+    except Exception as e:
+        print(f"Chain-agnostic lookup failed, trying per chain: {e}")
+        networks = list(CHAIN_IDS.items())
+        found = await asyncio.gather(*(fetch_token_info(chain_id, token_address) for _, chain_id in networks))
+        # fetch_token_info falls back to a pair on any chain, so keep only same-chain answers
+        return {
+            network: pair for (network, chain_id), pair in zip(networks, found)
+            if pair is not None and pair.chain_id.lower() == chain_id.lower()
+        }
+    pairs = pairs_for_address(pairs, token_address)
+    results = {}
+    for network, chain_id in CHAIN_IDS.items():
+        pair = market_snapshots.get(chain_id, token_address)
+        if pair is None:
+            chain_pairs = [p for p in pairs if p.chain_id.lower() == chain_id.lower()]
+            pair = select_best_pair(chain_pairs, chain_id)
+        if pair is not None:
+            results[network] = pair
+    return results
+
+async def build_inline_result(network, pair_data):
+    logo_url, token_info, chart_url = create_professional_message(pair_data, network)
+    result_id = hashlib.sha1(f"{network}|{pair_data.pair_address}".encode()).hexdigest()
+    title = f"{NETWORK_EMOJIS.get(network,'🔗')} {pair_data.base_symbol or 'Unknown'} on {network.upper()}"
+    description = (
+        f"{format_price(pair_data.price_usd)} • 24H {format_percentage(pair_data.change_h24)} • "
+        f"Liq {format_number(pair_data.liquidity_usd)}"
+    )
+    keyboard = None
+    if chart_url:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton("📊 View Live Chart", url=chart_url)]])
+
+    # A logo already uploaded once can be sent by file_id; otherwise Telegram fetches the thumbnail itself
+    file_id = None
+    if logo_url:
+        digest = await logo_cache.digest_for_url(logo_url, (300,300))
+        file_id = logo_cache.get_file_id(digest) if digest else None
+    if file_id:
+        return types.InlineQueryResultCachedPhoto(
+            id=result_id, photo_file_id=file_id, title=title, description=description,
+            caption=token_info, parse_mode=types.ParseMode.HTML, reply_markup=keyboard,
+        )
+    return types.InlineQueryResultArticle(
+        id=result_id, title=title, description=description, thumb_url=logo_url, reply_markup=keyboard,
+        input_message_content=types.InputTextMessageContent(
+            token_info, parse_mode=types.ParseMode.HTML, disable_web_page_preview=True,
+        ),
+    )
+
+async def answer_inline_lookup(inline_query: types.InlineQuery):
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    query = inline_query.query.strip()
+    try:
+        if not ADDRESS_PATTERN.fullmatch(query):
+            await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True,
+                                      switch_pm_text="Paste a token contract address", switch_pm_parameter="start")
+            return
+        try:
+            pairs = await fetch_token_info_all_chains(query)
+        except Exception as e:
+            print(f"Error fetching inline token info: {e}")
+            pairs = {}
+        results = [await build_inline_result(network, pair) for network, pair in pairs.items()]
+        if results:
+            await inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+        else:
+            await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True,
+                                      switch_pm_text="Token not found on supported networks", switch_pm_parameter="start")
+    except TelegramAPIError as e:
+        # Usually "query is too old": the user moved on before we answered
+        print(f"Inline answer failed: {e}")
+
+@dp.inline_handler(state='*')
+async def handle_inline_query(inline_query: types.InlineQuery):
+    user_id = inline_query.from_user.id
+    previous = inline_lookups.get(user_id)
+    if previous is not None:
+        previous.cancel()
+    task = asyncio.create_task(answer_inline_lookup(inline_query))
+    inline_lookups[user_id] = task
+    try:
+        # wait() rather than await, so a superseded lookup ends quietly
+        await asyncio.wait({task})
+    finally:
+        if inline_lookups.get(user_id) is task:
+            del inline_lookups[user_id]
+    if not task.cancelled() and task.exception() is not None:
+        raise task.exception()
 
 # ---------------- Start Trending Callback ----------------
 @dp.callback_query_handler(lambda c: c.data == "start_trending", state=UserState.waiting_for_trend_package)
@@ -299,15 +3670,17 @@ async def handle_start_trending(callback_query: types.CallbackQuery, state: FSMC
         [InlineKeyboardButton(f"24H", callback_data="trend_24h")]
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await callback_query.message.answer("📦 Select Trending Package:", reply_markup=keyboard)
+    await outbox.answer(callback_query.message, "📦 Select Trending Package:", reply_markup=keyboard)
 
 # ---------------- Handle Trending Selection ----------------
 @dp.callback_query_handler(lambda c: c.data.startswith("trend_"), state=UserState.waiting_for_trend_package)
 async def handle_trend_package_selection(callback_query: types.CallbackQuery, state: FSMContext):
-    await callback_query.answer()
-    
     user_data = await state.get_data()
     network = user_data.get("selected_network", "ethereum")
+    if network not in TRENDING_PACKAGES:
+        await callback_query.answer("Trending is no longer offered on this network.", show_alert=True)
+        return
+    await callback_query.answer()
     
     duration_map = {"trend_3h": "3h", "trend_12h": "12h", "trend_24h": "24h"}
     package = callback_query.data
@@ -316,12 +3689,20 @@ async def handle_trend_package_selection(callback_query: types.CallbackQuery, st
     # Get payment info
     payment_wallet = PAYMENT_WALLETS.get(network, "")
     packages = TRENDING_PACKAGES.get(network, {})
-    amount = packages.get(duration_label, 0)
+    auto_verified = network in PAYMENT_RPC_URLS
     
     network_emoji = NETWORK_EMOJIS.get(network, "🔗")
+
+    # Record the order now so the payment watcher can match the transfer to it
+    campaign_id, amount = await campaign_scheduler.create_order(
+        callback_query.from_user.id, network, user_data.get("contract_address", "N/A"), duration_label,
+        packages.get(duration_label, 0),
+    )
+    ledger.record("order", campaign_id=campaign_id, user_id=callback_query.from_user.id, network=network,
+                  token=user_data.get("contract_address", "N/A"), package=duration_label, amount=amount)
     
     # Store selected package info
-    await state.update_data(selected_package=duration_label, payment_amount=amount)
+    await state.update_data(selected_package=duration_label, payment_amount=amount, campaign_id=campaign_id)
     
     # Show payment info to user with "Paid" button
     payment_message = (
@@ -339,12 +3720,18 @@ async def handle_trend_package_selection(callback_query: types.CallbackQuery, st
         f"1️⃣ Send <b>{amount} {network.upper()}</b> to the wallet above\n"
         f"2️⃣ Click the <b>Paid</b> button below when done\n"
     )
+    if auto_verified:
+        payment_message += (
+            f"\n🤖 Payments are verified on-chain automatically. Send the <b>exact</b> amount "
+            f"within {PAYMENT_ORDER_TTL / 3600:g}h so we can match it to order <b>#{campaign_id}</b>"
+            + (f" (or add memo <code>OT{campaign_id}</code>)" if network == "solana" else "") + ".\n"
+        )
     
     paid_button = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton("✅ Paid", callback_data="payment_paid")]
     ])
     
-    await callback_query.message.answer(payment_message, reply_markup=paid_button)
+    await outbox.answer(callback_query.message, payment_message, reply_markup=paid_button)
     await UserState.waiting_for_payment.set()
 
 # ---------------- Handle Payment Confirmation ----------------
@@ -362,10 +3749,22 @@ async def handle_payment_paid(callback_query: types.CallbackQuery, state: FSMCon
     username = callback_query.from_user.username or "Unknown"
     user_id = callback_query.from_user.id
     user_full_name = callback_query.from_user.full_name or "Unknown"
+
+    campaign_id = user_data.get("campaign_id")
+    if campaign_id is None:
+        # Sessions that picked a package before orders were recorded at selection time
+        campaign_id = await campaign_scheduler.create(user_id, network, contract_address, selected_package, payment_amount)
+    ledger.record("claim", campaign_id=campaign_id, user_id=user_id, network=network, token=contract_address,
+                  package=selected_package, amount=payment_amount)
+    auto_verified = network in PAYMENT_RPC_URLS
     
     # Notify support team with activation button
     if SUPPORT_CHAT:
         try:
+            if auto_verified:
+                status_line = "<b>🤖 Auto-verification on - activates when the transfer confirms</b>"
+            else:
+                status_line = "<b>⚠️ User clicked PAID - Awaiting TX ID</b>"
             support_notification = (
                 f"╔══════════════════════════╗\n"
                 f"  <b>🚀 PAYMENT CLAIMED</b>\n"
@@ -375,29 +3774,39 @@ async def handle_payment_paid(callback_query: types.CallbackQuery, state: FSMCon
                 f"{network_emoji} <b>Network:</b> {network.upper()}\n"
                 f"📝 <b>Contract:</b> <code>{contract_address}</code>\n"
                 f"⏰ <b>Package:</b> {selected_package.upper()}\n"
-                f"💰 <b>Amount:</b> {payment_amount} {network.upper()}\n\n"
-                f"<b>⚠️ User clicked PAID - Awaiting TX ID</b>"
+                f"💰 <b>Amount:</b> {payment_amount} {network.upper()}\n"
+                f"🎫 <b>Campaign:</b> #{campaign_id}\n\n"
+                f"{status_line}"
             )
             
             # Add activation button for support
             activate_button = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton("✅ Activate Trending", callback_data=f"activate_{user_id}_{network}_{selected_package}")]
+                [InlineKeyboardButton("✅ Activate Trending", callback_data=f"activate_{user_id}_{network}_{selected_package}_{campaign_id}")]
             ])
             
-            await bot.send_message(SUPPORT_CHAT, support_notification, reply_markup=activate_button)
+            await outbox.send_message(SUPPORT_CHAT, support_notification, reply_markup=activate_button)
         except Exception as e:
             print(f"Could not send notification to support chat: {e}")
     
-    # Ask user to send TX ID to support
-    user_message = (
-        f"✅ <b>Payment Confirmed!</b>\n\n"
-        f"📩 <b>Next Step:</b>\n"
-        f"Please send your <b>Transaction ID (TX ID)</b> to our support team for verification.\n\n"
-        f"💬 <b>Send TX ID to:</b> @OmniTrendingPortal\n\n"
-        f"After verification, your trending will be activated!"
-    )
+    # Tell the user how verification continues
+    if auto_verified:
+        user_message = (
+            f"✅ <b>Payment Noted!</b>\n\n"
+            f"🤖 We're watching the {network.upper()} network for your transfer of "
+            f"<b>{payment_amount} {network.upper()}</b> (order #{campaign_id}).\n\n"
+            f"Your trending activates automatically once it confirms. "
+            f"Questions? Contact @OmniTrendingPortal."
+        )
+    else:
+        user_message = (
+            f"✅ <b>Payment Confirmed!</b>\n\n"
+            f"📩 <b>Next Step:</b>\n"
+            f"Please send your <b>Transaction ID (TX ID)</b> to our support team for verification.\n\n"
+            f"💬 <b>Send TX ID to:</b> @OmniTrendingPortal\n\n"
+            f"After verification, your trending will be activated!"
+        )
     
-    await callback_query.message.answer(user_message)
+    await outbox.answer(callback_query.message, user_message)
     await state.finish()
 
 # ---------------- Activate Trending (Support Only) ----------------
@@ -405,37 +3814,32 @@ async def handle_payment_paid(callback_query: types.CallbackQuery, state: FSMCon
 async def handle_activate_trending(callback_query: types.CallbackQuery):
     await callback_query.answer()
     
-    # Parse callback data: activate_{user_id}_{network}_{package}
+    # Parse callback data: activate_{user_id}_{network}_{package}[_{campaign_id}]
     parts = callback_query.data.split("_")
     if len(parts) >= 4:
         target_user_id = int(parts[1])
         network = parts[2]
         package = parts[3]
         
-        network_emoji = NETWORK_EMOJIS.get(network, "🔗")
-        
         # Notify the user that trending is activated
         try:
-            user_activation_message = (
-                f"🎉 <b>TRENDING ACTIVATED!</b>\n\n"
-                f"{network_emoji} <b>Network:</b> {network.upper()}\n"
-                f"⏰ <b>Duration:</b> {package.upper()}\n\n"
-                f"Your token is now trending! 🚀\n\n"
-                f"Thank you for using OmniTrending!"
-            )
-            await bot.send_message(target_user_id, user_activation_message)
+            if len(parts) >= 5:
+                campaign_id = int(parts[4])
+            else:
+                # Buttons sent before campaigns were recorded carry no id or token
+                campaign_id = await campaign_scheduler.create(target_user_id, network, "N/A", package)
+            campaign = await activate_campaign(campaign_id, actor=f"support:{callback_query.from_user.id}")
+            if campaign is None:
+                await outbox.answer(callback_query.message, f"ℹ️ Campaign #{campaign_id} is already activated or closed.")
+                return
             
             # Update support message
-            await callback_query.message.edit_text(
+            await outbox.edit(callback_query.message,
                 callback_query.message.text + f"\n\n✅ <b>ACTIVATED by {callback_query.from_user.full_name}</b>"
             )
             
         except Exception as e:
-            await callback_query.message.answer(f"❌ Error activating trending: {e}")
-
-async def trending_timer(user_id, duration):
-    await asyncio.sleep(duration)
-    await bot.send_message(user_id, "⏰ Your trending period has ended. Thank you for using OmniTrending!")
+            await outbox.answer(callback_query.message, f"❌ Error activating trending: {e}")
 
 # ---------------- Main Menu ----------------
 @dp.callback_query_handler(lambda c: c.data == "main_menu", state='*')
@@ -444,16 +3848,11 @@ async def handle_main_menu(callback_query: types.CallbackQuery, state: FSMContex
     await callback_query.answer()
     user_first = callback_query.from_user.first_name or "there"
     start_text = f"╔══════════════════════════╗\n  <b>🌟 OMNITRENDING BOT 🌟</b>\n╚══════════════════════════╝\n\n👋 Welcome back, <b>{user_first}</b>!\nSelect a network below to get started! 👇"
-    buttons = [
-        [InlineKeyboardButton("💜 Solana", callback_data="select_solana")],
-        [InlineKeyboardButton("💠 Ethereum", callback_data="select_ethereum")],
-        [InlineKeyboardButton("🟡 BSC", callback_data="select_bsc")],
-        [InlineKeyboardButton("🧊 Base", callback_data="select_base")],
-        [InlineKeyboardButton("⚪ Arbitrum", callback_data="select_arbitrum")],
+    buttons = network_menu_rows() + [
         [InlineKeyboardButton("🛠️ Support", callback_data="support")]
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await callback_query.message.edit_text(start_text, reply_markup=keyboard)
+    await outbox.edit(callback_query.message, start_text, reply_markup=keyboard)
 
 # ---------------- Show Prices Handler ----------------
 @dp.callback_query_handler(lambda c: c.data == "show_prices", state='*')
@@ -487,7 +3886,7 @@ async def handle_show_prices(callback_query: types.CallbackQuery):
         [InlineKeyboardButton("🔙 Back to Menu", callback_data="main_menu")]
     ])
     
-    await callback_query.message.answer(prices_text, reply_markup=back_button)
+    await outbox.answer(callback_query.message, prices_text, reply_markup=back_button)
 
 # ---------------- Support Handler ----------------
 @dp.callback_query_handler(lambda c: c.data == "support", state='*')
@@ -499,16 +3898,50 @@ async def handle_support(callback_query: types.CallbackQuery):
         "📩 <a href='https://t.me/OmniTrendingPortal'>Contact Support</a>\n\n"
         "We'll respond as quickly as possible!"
     )
-    await callback_query.message.answer(support_text, disable_web_page_preview=True)
+    await outbox.answer(callback_query.message, support_text, disable_web_page_preview=True)
 
 # ---------------- Run Bot ----------------
 async def on_startup(dp):
     commands = [
         types.BotCommand(command="start", description="🏠 Start the bot"),
-        types.BotCommand(command="help", description="📘 How to use the bot")
+        types.BotCommand(command="help", description="📘 How to use the bot"),
+        types.BotCommand(command="alerts", description="🔔 Your price alerts")
     ]
-    await bot.set_my_commands(commands)
-    print("🚀 OmniTrending bot is now running...")
+    dp.storage = create_storage()
+    get_http_session()
+    await start_metrics_server()
+    await ledger.start()
+    if IS_LEADER:
+        await bot.set_my_commands(commands)
+        await campaign_scheduler.start()
+        await load_leaderboard()
+    else:
+        # Campaign timers, refreshes and payment polling run on shard 0 only
+        await run_db(campaign_scheduler._init_db)
+    await alert_engine.load()
+    if IS_LEADER:
+        if leaderboard_publisher:
+            await leaderboard_publisher.start()
+        await market_refresher.start()
+        await payment_watcher.start()
+    await config_watcher.start()
+    print("🚀 OmniTrending bot is now running..." + (f" (shard {SHARD_ID} of {SHARDS})" if SHARD_ID >= 0 else ""))
+
+async def on_shutdown(dp):
+    await config_watcher.stop()
+    await payment_watcher.stop()
+    await market_refresher.stop()
+    if leaderboard_publisher:
+        await leaderboard_publisher.stop()
+    await campaign_scheduler.stop()
+    await ledger.stop()
+    await outbox.drain()
+    await stop_metrics_server()
+    await close_http_session()
+    shutdown_image_pool()
+    await dp.storage.close()
+    await run_db(close_db)
+    print("👋 OmniTrending bot stopped.")
 
 @dp.message_handler(commands=['help'], state='*')
 async def help_command(message: types.Message):
@@ -520,7 +3953,528 @@ async def help_command(message: types.Message):
         "4️⃣ Use the trending system to boost token visibility.\n\n"
         "Need more assistance? Tap <b>Support</b> below."
     )
-    await message.answer(help_text)
+    await outbox.answer(message, help_text)
+
+# ---------------- Stats Command (Support Only) ----------------
+def is_support_chat(message: types.Message):
+    return bool(SUPPORT_CHAT) and str(message.chat.id) == str(SUPPORT_CHAT)
+
+@dp.message_handler(commands=['stats'], state='*')
+async def stats_command(message: types.Message):
+    if not is_support_chat(message):
+        return
+    cache = token_cache.stats()
+    logos = logo_cache.stats()
+    refresh = market_refresher.stats()
+    sends = outbox.stats()
+    providers = market_data.stats()
+    network_config = config_watcher.stats()
+    alerts = alert_engine.stats()
+    orders = ledger.stats()
+    provider_lines = []
+    for name, p in providers['providers'].items():
+        p95 = f"{p['p95']:.2f}s" if p['p95'] is not None else "n/a"
+        circuit = " (circuit open)" if p['open'] else ""
+        provider_lines.append(f"{name}: {p['requests']} requests, {p['errors']} errors, p95 {p95}{circuit}")
+    provider_text = "".join(
+        f"{'└' if i == len(provider_lines) - 1 else '├'} {line}\n" for i, line in enumerate(provider_lines)
+    )
+    stats_text = (
+        f"📈 <b>Bot Stats</b>\n\n"
+        f"<b>Token cache:</b> {cache['size']}/{cache['maxsize']} entries\n"
+        f"├ Hits: {cache['hits']}\n"
+        f"├ Coalesced: {cache['coalesced']}\n"
+        f"├ Misses: {cache['misses']}\n"
+        f"├ Evictions: {cache['evictions']}\n"
+        f"└ Hit rate: {cache['hit_rate']:.1%}\n\n"
+        f"<b>Logo cache:</b> {logos['entries']} logos, {logos['bytes'] / 1024:.0f}/{logos['max_bytes'] / 1024:.0f} KB\n"
+        f"├ Hits: {logos['hits']} (disk: {logos['disk_hits']})\n"
+        f"├ Misses: {logos['misses']}\n"
+        f"├ Evictions: {logos['evictions']} (disk files swept: {logos['swept']})\n"
+        f"└ Reused file_ids: {logos['file_id_hits']} of {logos['file_ids']} known\n\n"
+        f"<b>Market refresher:</b> {refresh['tracked']} tracked tokens\n"
+        f"├ Snapshots: {refresh['snapshots']} (served {refresh['snapshot_hits']} lookups)\n"
+        f"├ Passes: {refresh['passes']} (last {refresh['last_duration']:.2f}s)\n"
+        f"└ Rate limited: {refresh['rate_limited']} (backoff {refresh['backoff']:.0f}s)\n\n"
+        f"<b>Market data:</b> {providers['hedged']} hedged, {providers['hedge_wins']} won by the hedge, "
+        f"{providers['failovers']} failovers\n"
+        f"{provider_text}\n"
+        f"<b>Price alerts:</b> {alerts['alerts']} for {alerts['users']} users\n"
+        f"├ Delivered: {alerts['fired']} (rate-limited {alerts['suppressed']})\n"
+        f"└ Evaluations: {alerts['evaluations']} (last {alerts['last_duration'] * 1000:.1f}ms)\n\n"
+        f"<b>Order ledger:</b> {orders['written']} events written, {orders['pending']} pending\n\n"
+        f"<b>Network config:</b> v{network_config['version']}, {network_config['networks']} networks"
+        f"{' from ' + network_config['path'] if network_config['path'] else ' (built-in)'}\n"
+        + (f"└ Last change rejected: {network_config['last_error']}\n\n" if network_config['last_error'] else "\n") +
+        f"<b>Outbound queue:</b> {sends['depth']} queued across {sends['chats']} chats\n"
+        f"├ Sent: {sends['sent']} (failed {sends['failed']})\n"
+        f"├ Flood waits retried: {sends['retried']}\n"
+        f"├ Edits coalesced: {sends['coalesced']}\n"
+        f"└ Latency: {sends['latency_avg']:.2f}s avg, {sends['latency_max']:.2f}s max\n"
+    )
+    if shared_token_cache:
+        shared = shared_token_cache.stats()
+        stats_text += (
+            f"\n<b>Shard:</b> {SHARD_ID} of {SHARDS} (figures above are this shard's)\n"
+            f"└ Shared token cache: {shared['hits']} hits, {shared['misses']} misses, {shared['writes']} writes\n"
+        )
+    await outbox.answer(message, stats_text)
+
+# ---------------- Campaign Commands (Support Only) ----------------
+def format_campaign_line(campaign):
+    remaining = max(0, campaign['expires_at'] - time.time())
+    return (
+        f"#{campaign['id']} {NETWORK_EMOJIS.get(campaign['network'],'🔗')} {campaign['network'].upper()} "
+        f"{campaign['package'].upper()} • user <code>{campaign['user_id']}</code>\n"
+        f"   <code>{campaign['token']}</code>\n"
+        f"   {campaign['status']} • ends {format_timestamp(campaign['expires_at'])} ({remaining / 3600:.1f}h left)"
+    )
+
+@dp.message_handler(commands=['campaigns'], state='*')
+async def campaigns_command(message: types.Message):
+    # /campaigns [user_id | network | token]
+    if not is_support_chat(message):
+        return
+    query = message.get_args().strip()
+    if query.isdigit():
+        campaigns = campaign_scheduler.list(user_id=int(query))
+    elif query.lower() in CHAIN_IDS:
+        campaigns = campaign_scheduler.list(network=query.lower())
+    elif query:
+        campaigns = campaign_scheduler.list(token=query)
+    else:
+        campaigns = campaign_scheduler.list()
+    if not campaigns:
+        await outbox.answer(message, "📭 No active campaigns found.")
+        return
+    text = f"📋 <b>Active Campaigns ({len(campaigns)})</b>\n\n"
+    for campaign in campaigns:
+        line = format_campaign_line(campaign) + "\n\n"
+        if len(text) + len(line) > 4000:
+            await outbox.answer(message, text)
+            text = ""
+        text += line
+    await outbox.answer(message, text)
+
+@dp.message_handler(commands=['extend'], state='*')
+async def extend_command(message: types.Message):
+    # /extend <campaign_id> <hours>
+    if not is_support_chat(message):
+        return
+    args = message.get_args().split()
+    try:
+        campaign_id, hours = int(args[0]), float(args[1])
+    except (IndexError, ValueError):
+        await outbox.answer(message, "Usage: <code>/extend &lt;campaign_id&gt; &lt;hours&gt;</code>")
+        return
+    campaign = await campaign_scheduler.extend(campaign_id, hours * 3600)
+    if campaign is None:
+        await outbox.answer(message, f"❌ Campaign #{campaign_id} is not active.")
+        return
+    ledger.record("extend", campaign, actor=f"support:{message.from_user.id}", detail=f"+{hours:g}h")
+    await outbox.answer(message, f"✅ Extended by {hours:g}h\n\n{format_campaign_line(campaign)}")
+
+@dp.message_handler(commands=['cancel'], state='*')
+async def cancel_command(message: types.Message):
+    # /cancel <campaign_id>
+    if not is_support_chat(message):
+        return
+    try:
+        campaign_id = int(message.get_args().split()[0])
+    except (IndexError, ValueError):
+        await outbox.answer(message, "Usage: <code>/cancel &lt;campaign_id&gt;</code>")
+        return
+    campaign = await campaign_scheduler.cancel(campaign_id)
+    if campaign is None:
+        await outbox.answer(message, f"❌ Campaign #{campaign_id} is not active.")
+        return
+    ledger.record("cancel", campaign, actor=f"support:{message.from_user.id}")
+    await outbox.answer(message, f"🛑 Campaign #{campaign_id} cancelled.")
+
+# ---------------- Ledger Commands (Support Only) ----------------
+LEDGER_EVENT_EMOJIS = {"order": "🛒", "claim": "💳", "activation": "✅", "extend": "⏩", "cancel": "🛑", "expiry": "⏰"}
+
+def format_ledger_line(row):
+    network = row['network'] or ""
+    line = (
+        f"{LEDGER_EVENT_EMOJIS.get(row['event'], '•')} <b>{row['event']}</b> #{row['campaign_id']} • "
+        f"{format_timestamp(row['ts'])}\n"
+        f"   {NETWORK_EMOJIS.get(network, '🔗')} {network.upper()} {(row['package'] or '').upper()} • "
+        f"{row['amount'] or 0:g} • user <code>{row['user_id']}</code>\n"
+        f"   <code>{row['token']}</code>"
+    )
+    extras = [value for value in (row['detail'], row['actor'] and f"by {row['actor']}") if value]
+    if row['tx_hash']:
+        extras.append(f"tx <code>{row['tx_hash']}</code>")
+    if extras:
+        line += "\n   " + " • ".join(extras)
+    return line
+
+@dp.message_handler(commands=['orders'], state='*')
+async def orders_command(message: types.Message):
+    # /orders [user_id | network | token | #campaign_id]
+    if not is_support_chat(message):
+        return
+    query = message.get_args().strip()
+    started = time.perf_counter()
+    if query.startswith("#") and query[1:].isdigit():
+        rows = await ledger.events(campaign_id=int(query[1:]))
+    elif query.isdigit():
+        rows = await ledger.events(user_id=int(query))
+    elif query.lower() in CHAIN_IDS:
+        rows = await ledger.events(network=query.lower())
+    elif query:
+        rows = await ledger.events(token=query)
+    else:
+        rows = await ledger.events()
+    elapsed = (time.perf_counter() - started) * 1000
+    if not rows:
+        await outbox.answer(message, f"📭 No orders found. ({elapsed:.1f}ms)")
+        return
+    text = f"🧾 <b>Order Ledger</b> - latest {len(rows)} events ({elapsed:.1f}ms)\n\n"
+    for row in rows:
+        line = format_ledger_line(row) + "\n\n"
+        if len(text) + len(line) > 4000:
+            await outbox.answer(message, text)
+            text = ""
+        text += line
+    await outbox.answer(message, text)
+
+@dp.message_handler(commands=['revenue'], state='*')
+async def revenue_command(message: types.Message):
+    # /revenue [days] - activated and claimed amounts per network
+    if not is_support_chat(message):
+        return
+    try:
+        days = float(message.get_args().split()[0]) if message.get_args().strip() else 30
+    except ValueError:
+        await outbox.answer(message, "Usage: <code>/revenue [days]</code>")
+        return
+    started = time.perf_counter()
+    rows = await ledger.revenue(time.time() - days * 86400)
+    elapsed = (time.perf_counter() - started) * 1000
+    totals = {}
+    for row in rows:
+        totals.setdefault(row['network'], {})[row['event']] = row
+    if not totals:
+        await outbox.answer(message, f"📭 No claims or activations in the last {days:g} days. ({elapsed:.1f}ms)")
+        return
+    lines = [f"💰 <b>Revenue - last {days:g} days</b> ({elapsed:.1f}ms)\n"]
+    for network, events in sorted(totals.items()):
+        activated = events.get("activation") or {"events": 0, "amount": 0}
+        claimed = events.get("claim") or {"events": 0, "amount": 0}
+        lines.append(
+            f"{NETWORK_EMOJIS.get(network, '🔗')} <b>{network.upper()}</b>: {round(activated['amount'] or 0, 6):g} "
+            f"from {activated['events']} activations\n"
+            f"   {claimed['events']} claims ({round(claimed['amount'] or 0, 6):g})"
+        )
+    await outbox.answer(message, "\n".join(lines))
+
+# ---------------- Webhook Mode ----------------
+class UpdateWorkerPool:
+    # Bounded queue of incoming updates processed by a fixed number of workers, so a burst
+    # of webhook calls can't spawn unbounded handler tasks. drain() lets queued updates
+    # finish before shutdown.
+    def __init__(self, dispatcher, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.closing = False
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, update):
+        if self.closing:
+            return False
+        try:
+            self.queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _worker(self):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        while True:
+            update = await self.queue.get()
+            try:
+                # A task per update gives it a fresh context; aiogram caches the FSM state
+                # in context variables, which would otherwise leak into the next update
+                await asyncio.create_task(self.dispatcher.process_update(update))
+            except Exception as e:
+                print(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    async def drain(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        self.closing = True
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Shutdown drain timed out with {self.queue.qsize()} updates left")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+async def handle_webhook_request(request: web.Request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=401)
+    try:
+        update = types.Update(**(await request.json()))
+    except Exception:
+        return web.Response(status=400)
+    # 503 makes Telegram redeliver the update later instead of us dropping it
+    if not request.app["updates"].submit(update):
+        return web.Response(status=503)
+    return web.Response()
+
+async def handle_healthcheck(request: web.Request):
+    return web.json_response({"ok": True, "queued_updates": request.app["updates"].qsize()})
+
+async def on_webhook_app_startup(app: web.Application):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    app["updates"].start()
+    await bot.set_webhook(WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          max_connections=min(WEBHOOK_WORKERS, 100))
+    print(f"🌐 Webhook mode: listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+async def on_webhook_app_shutdown(app: web.Application):
+    # The webhook stays registered so Telegram keeps queuing updates while we restart
+    await app["updates"].drain()
+    await on_shutdown(dp)
+    await dp.storage.wait_closed()
+    session = await bot.get_session()
+    await session.close()
+
+def create_webhook_app():
+    app = web.Application()
+    app["updates"] = UpdateWorkerPool(dp)
+    app.router.add_post(WEBHOOK_PATH, handle_webhook_request)
+    app.router.add_get("/healthz", handle_healthcheck)
+    app.on_startup.append(on_webhook_app_startup)
+    app.on_shutdown.append(on_webhook_app_shutdown)
+    return app
+
+def run_webhook():
+    if not WEBHOOK_HOST:
+        raise ValueError("❌ WEBHOOK_HOST environment variable is required when RUN_MODE=webhook!")
+    web.run_app(create_webhook_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+# ---------------- Sharded Mode ----------------
+def session_shard(chat_id, user_id, shards=SHARDS):
+    # SUPPORT_CHAT always goes to shard 0, everything else by user id
+    if SUPPORT_CHAT and str(chat_id) == str(SUPPORT_CHAT):
+        return 0
+    return int(user_id or 0) % shards
+
+def update_shard(data, shards=SHARDS):
+    # Every update kind carries one object; route by its sender so a user's FSM session
+    # and in-memory state stay on one shard
+    event = next((v for k, v in data.items() if k != "update_id" and isinstance(v, dict)), {})
+    chat = event.get("chat") or (event.get("message") or {}).get("chat") or {}
+    sender = event.get("from") or event.get("user") or chat
+    return session_shard(chat.get("id"), sender.get("id"), shards)
+
+class ShardRouter:
+    # Front process of the sharded mode: hands each update to its worker process over a
+    # bounded multiprocessing queue, restarts workers that die, and on stop sends every
+    # worker a None so it drains its queue and shuts down in order.
+    SUPERVISE_INTERVAL = 5
+
+    def __init__(self, shards=SHARDS, queue_size=SHARD_QUEUE_SIZE):
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue(queue_size) for _ in range(shards)]
+        self.processes = [None] * shards
+        self.routed = [0] * shards
+        self.rejected = 0
+        self.restarts = 0
+        self.closing = False
+        self._task = None
+
+    def start(self):
+        for shard in range(len(self.queues)):
+            self._spawn(shard)
+        print(f"🧩 Started {len(self.queues)} shards")
+
+    def _spawn(self, shard):
+        # Spawned children re-import this module, so the shard id travels in the environment
+        os.environ["SHARD_ID"] = str(shard)
+        try:
+            process = self.context.Process(target=run_shard, args=(self.queues[shard],), name=f"shard-{shard}")
+            process.start()
+        finally:
+            del os.environ["SHARD_ID"]
+        self.processes[shard] = process
+
+    def submit(self, update):
+        if self.closing:
+            return False
+        data = update.to_python()
+        shard = update_shard(data, len(self.queues))
+        try:
+            self.queues[shard].put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.routed[shard] += 1
+        return True
+
+    def qsize(self):
+        try:
+            return sum(q.qsize() for q in self.queues)
+        except NotImplementedError:  # macOS
+            return -1
+
+    def watch(self):
+        self._task = asyncio.create_task(self._supervise())
+
+    async def unwatch(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(self.SUPERVISE_INTERVAL)
+            for shard, process in enumerate(self.processes):
+                if not self.closing and process is not None and not process.is_alive():
+                    print(f"⚠️ Shard {shard} exited with code {process.exitcode}, restarting")
+                    self.restarts += 1
+                    self._spawn(shard)
+
+    def stop(self, timeout=WEBHOOK_DRAIN_TIMEOUT + 10):
+        self.closing = True
+        for q in self.queues:
+            q.put(None)
+        deadline = time.monotonic() + timeout
+        for shard, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"⚠️ Shard {shard} did not stop in time, terminating")
+                process.terminate()
+                process.join()
+
+def run_shard(updates):
+    # Worker process entry point. Ctrl+C reaches the whole process group; only the front
+    # acts on it, and stops the workers through their queues.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(updates))
+
+async def serve_shard(updates):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    pool = UpdateWorkerPool(dp)
+    pool.start()
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    async def enqueue(data):
+        await pool.queue.put(types.Update(**data))
+
+    def read():
+        # Blocking queue reads stay off the event loop; a full pool holds back the reader,
+        # which in turn fills the multiprocessing queue and pushes back on the front
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                data = updates.get(timeout=1)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            if data is None:
+                break
+            asyncio.run_coroutine_threadsafe(enqueue(data), loop).result()
+        loop.call_soon_threadsafe(finished.set_result, None)
+
+    threading.Thread(target=read, name="shard-reader", daemon=True).start()
+    await finished
+    await pool.drain()
+    await on_shutdown(dp)
+    await dp.storage.wait_closed()
+    session = await bot.get_session()
+    await session.close()
+
+async def poll_for_shards(router):
+    Bot.set_current(bot)
+    await dp.skip_updates()
+    router.watch()
+    print(f"🧩 Polling for {len(router.queues)} shards")
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=20)
+            except Exception as e:
+                print(f"Error getting updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                # Unlike a webhook we can't ask Telegram to redeliver, so wait for room
+                while not router.submit(update):
+                    await asyncio.sleep(0.1)
+                offset = update.update_id + 1
+    finally:
+        await router.unwatch()
+        session = await bot.get_session()
+        await session.close()
+
+async def on_front_app_startup(app: web.Application):
+    Bot.set_current(bot)
+    app["updates"].watch()
+    await bot.set_webhook(WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          max_connections=min(WEBHOOK_WORKERS * SHARDS, 100))
+    print(f"🌐 Webhook mode: listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH} for {SHARDS} shards")
+
+async def on_front_app_shutdown(app: web.Application):
+    await app["updates"].unwatch()
+    session = await bot.get_session()
+    await session.close()
+
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_sharded():
+    # Single launcher: this process takes updates from Telegram and starts SHARDS workers
+    if RUN_MODE == "webhook" and not WEBHOOK_HOST:
+        raise ValueError("❌ WEBHOOK_HOST environment variable is required when RUN_MODE=webhook!")
+    router = ShardRouter()
+    router.start()
+    try:
+        if RUN_MODE == "webhook":
+            app = web.Application()
+            app["updates"] = router
+            app.router.add_post(WEBHOOK_PATH, handle_webhook_request)
+            app.router.add_get("/healthz", handle_healthcheck)
+            app.on_startup.append(on_front_app_startup)
+            app.on_shutdown.append(on_front_app_shutdown)
+            web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+        else:
+            signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+            try:
+                asyncio.run(poll_for_shards(router))
+            except KeyboardInterrupt:
+                pass
+    finally:
+        router.stop()
+        print(f"👋 Stopped {len(router.queues)} shards")
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    if SHARDS > 1:
+        run_sharded()
+    elif RUN_MODE == "webhook":
+        run_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
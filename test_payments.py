@@ -0,0 +1,247 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from decimal import Decimal
+
+# main.py reads its settings at import time
+os.environ.update({
+    "BOT_TOKEN": "123456:TESTTESTTESTTESTTESTTESTTESTTESTTEST",
+    "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="omnitrending-test-"), "test.db"),
+    "PAYMENT_RPC_ETHEREUM": "http://rpc.invalid/ethereum",
+    "PAYMENT_RPC_SOLANA": "http://rpc.invalid/solana",
+    "METRICS_PORT": "0",
+})
+for name in ("SUPPORT_CHAT", "CONFIG_PATH", "LEADERBOARD_CHAT"):
+    os.environ.pop(name, None)
+
+import main
+
+EVM_WALLET = main.PAYMENT_WALLETS["ethereum"]
+SOL_WALLET = main.PAYMENT_WALLETS["solana"]
+
+def wei(amount):
+    return int(Decimal(str(amount)) * 10 ** 18)
+
+def lamports(amount):
+    return int(Decimal(str(amount)) * 10 ** 9)
+
+class StubRPC:
+    # Stands in for rpc_batch: answers from in-memory blocks / signatures and records calls
+    def __init__(self, head=None, blocks=None, receipts=None, signatures=None, transactions=None):
+        self.head = head
+        self.blocks = blocks or {}
+        self.receipts = receipts or {}
+        self.signatures = signatures or []   # newest first, like getSignaturesForAddress
+        self.transactions = transactions or {}
+        self.calls = []
+
+    async def __call__(self, url, calls):
+        self.calls.extend(method for method, _ in calls)
+        return [self.answer(method, params) for method, params in calls]
+
+    def answer(self, method, params):
+        if method == "eth_blockNumber":
+            return hex(self.head)
+        if method == "eth_getBlockByNumber":
+            return self.blocks.get(int(params[0], 16), {"transactions": []})
+        if method == "eth_getTransactionReceipt":
+            return self.receipts.get(params[0], {"status": "0x1"})
+        if method == "getSignaturesForAddress":
+            options = params[1]
+            signatures = [s["signature"] for s in self.signatures]
+            page = self.signatures
+            if options.get("until") in signatures:
+                page = page[:signatures.index(options["until"])]
+            return page[:options.get("limit", 1000)]
+        if method == "getTransaction":
+            return self.transactions.get(params[0])
+        raise AssertionError(f"unexpected RPC call {method}")
+
+def sol_transfer(received, wallet=SOL_WALLET):
+    return {
+        "meta": {"err": None, "preBalances": [5 * 10 ** 9, 0], "postBalances": [5 * 10 ** 9 - received, received]},
+        "transaction": {"message": {"accountKeys": ["Payer1111111111111111111111111111111111111", wallet]}},
+    }
+
+class PaymentWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self._send = main.outbox.send_message
+        self._rpc = main.rpc_batch
+
+        async def record_send(chat_id, text, **kwargs):
+            self.sent.append((chat_id, text))
+        main.outbox.send_message = record_send
+        main.campaign_scheduler.live.clear()
+        self.run_async(main.run_db(main.CampaignScheduler._init_db))
+        self.run_async(main.run_db(self._reset_db))
+        self.watcher = main.PaymentWatcher(rpc_urls={"ethereum": "stub", "solana": "stub"})
+
+    def tearDown(self):
+        main.outbox.send_message = self._send
+        main.rpc_batch = self._rpc
+
+    @staticmethod
+    def _reset_db():
+        main._init_kv()
+        db = main.get_db()
+        with db:
+            db.execute("DELETE FROM campaigns")
+            db.execute("DELETE FROM kv")
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def stub(self, **kwargs):
+        main.rpc_batch = StubRPC(**kwargs)
+        return main.rpc_batch
+
+    def order(self, network, amount, user_id=1):
+        return self.run_async(main.campaign_scheduler.create(user_id, network, "0xtoken", "3h", amount))
+
+    def campaign(self, campaign_id):
+        return self.run_async(main.run_db(main.fetch_dicts, "SELECT * FROM campaigns WHERE id = ?", (campaign_id,)))[0]
+
+    def cursor(self, network):
+        return self.run_async(main.run_db(main.kv_get, f"payment_cursor:{network}"))
+
+    def set_cursor(self, network, value):
+        self.run_async(main.run_db(main.kv_set, f"payment_cursor:{network}", value))
+
+    # ---------------- EVM ----------------
+    def test_evm_first_run_starts_at_safe_head(self):
+        rpc = self.stub(head=1000)
+        self.run_async(self.watcher.poll_evm("ethereum", "stub", EVM_WALLET))
+        self.assertEqual(self.cursor("ethereum"), str(1000 - main.PAYMENT_CONFIRMATIONS))
+        self.assertEqual(rpc.calls, ["eth_blockNumber"])
+
+    def test_evm_exact_amount_activates_order_and_advances_cursor(self):
+        paid = self.order("ethereum", 0.015123)
+        other = self.order("ethereum", 0.015124, user_id=2)
+        self.set_cursor("ethereum", 100)
+        self.stub(
+            head=103 + main.PAYMENT_CONFIRMATIONS,
+            blocks={
+                101: {"transactions": [{"hash": "0xshort", "to": EVM_WALLET.lower(), "value": hex(wei(0.015122))}]},
+                102: {"transactions": [
+                    {"hash": "0xfailed", "to": EVM_WALLET, "value": hex(wei(0.015124))},
+                    {"hash": "0xpaid", "to": EVM_WALLET.upper().replace("0X", "0x"), "value": hex(wei(0.015123))},
+                ]},
+            },
+            receipts={"0xfailed": {"status": "0x0"}},
+        )
+        self.run_async(self.watcher.poll_evm("ethereum", "stub", EVM_WALLET))
+
+        self.assertEqual(self.campaign(paid)['status'], "scheduled")
+        self.assertEqual(self.campaign(paid)['tx_hash'], "0xpaid")
+        self.assertEqual(self.campaign(other)['status'], "pending")  # its transfer reverted
+        self.assertEqual((self.watcher.matched, self.watcher.unmatched), (1, 1))
+        self.assertEqual(self.cursor("ethereum"), "103")
+        self.assertEqual([chat for chat, _ in self.sent], [1])
+
+    def test_evm_scans_at_most_max_blocks_per_poll(self):
+        self.set_cursor("ethereum", 0)
+        rpc = self.stub(head=10 ** 6)
+        self.run_async(self.watcher.poll_evm("ethereum", "stub", EVM_WALLET))
+        self.assertEqual(self.cursor("ethereum"), str(main.PAYMENT_MAX_BLOCKS))
+        self.assertEqual(rpc.calls.count("eth_getBlockByNumber"), main.PAYMENT_MAX_BLOCKS)
+
+    # ---------------- Solana ----------------
+    def test_solana_first_run_starts_at_newest_signature(self):
+        rpc = self.stub(signatures=[{"signature": "S2"}, {"signature": "S1"}])
+        self.run_async(self.watcher.poll_solana("solana", "stub", SOL_WALLET))
+        self.assertEqual(self.cursor("solana"), "S2")
+        self.assertNotIn("getTransaction", rpc.calls)
+
+    def test_solana_empty_first_run_still_matches_the_first_payment(self):
+        rpc = self.stub()
+        self.run_async(self.watcher.poll_solana("solana", "stub", SOL_WALLET))
+        self.assertEqual(self.cursor("solana"), "")
+
+        paid = self.order("solana", 0.250417)
+        rpc.signatures = [{"signature": "S1"}]
+        rpc.transactions = {"S1": sol_transfer(lamports(0.250417))}
+        self.run_async(self.watcher.poll_solana("solana", "stub", SOL_WALLET))
+        self.assertEqual(self.campaign(paid)['status'], "scheduled")
+        self.assertEqual(self.cursor("solana"), "S1")
+
+    def test_solana_exact_lamports_activate_order(self):
+        paid = self.order("solana", 0.250417)
+        self.set_cursor("solana", "S0")
+        self.stub(
+            signatures=[{"signature": "S2"}, {"signature": "S1"}, {"signature": "S0"}],
+            transactions={"S1": sol_transfer(lamports(0.250416)), "S2": sol_transfer(lamports(0.250417))},
+        )
+        self.run_async(self.watcher.poll_solana("solana", "stub", SOL_WALLET))
+
+        self.assertEqual(self.campaign(paid)['status'], "scheduled")
+        self.assertEqual(self.campaign(paid)['tx_hash'], "S2")
+        self.assertEqual(self.watcher.unmatched, 1)
+        self.assertEqual(self.cursor("solana"), "S2")
+
+    def test_solana_memo_wins_over_amount(self):
+        by_memo = self.order("solana", 0.1)
+        by_amount = self.order("solana", 0.2, user_id=2)
+        self.set_cursor("solana", "S0")
+        self.stub(
+            signatures=[{"signature": "S1", "memo": f"[6] OT{by_memo}"}, {"signature": "S0"}],
+            transactions={"S1": sol_transfer(lamports(0.2))},
+        )
+        self.run_async(self.watcher.poll_solana("solana", "stub", SOL_WALLET))
+        self.assertEqual(self.campaign(by_memo)['status'], "scheduled")
+        self.assertEqual(self.campaign(by_amount)['status'], "pending")
+
+    def test_underpaid_memo_falls_back_to_amount(self):
+        by_memo = self.order("solana", 0.3)
+        by_amount = self.order("solana", 0.2, user_id=2)
+        self.set_cursor("solana", "S0")
+        self.stub(
+            signatures=[{"signature": "S1", "memo": f"OT-{by_memo}"}, {"signature": "S0"}],
+            transactions={"S1": sol_transfer(lamports(0.2))},
+        )
+        self.run_async(self.watcher.poll_solana("solana", "stub", SOL_WALLET))
+        self.assertEqual(self.campaign(by_memo)['status'], "pending")
+        self.assertEqual(self.campaign(by_amount)['status'], "scheduled")
+
+    # ---------------- Order amounts ----------------
+    def test_open_orders_never_share_an_amount(self):
+        async def place_orders():
+            # All at once, as concurrent users would
+            return await asyncio.gather(*(
+                main.campaign_scheduler.create_order(user_id, "ethereum", "0xtoken", "3h", 0.1)
+                for user_id in range(200)
+            ))
+        orders = self.run_async(place_orders())
+        amounts = [amount for _, amount in orders]
+        self.assertEqual(len(set(amounts)), len(amounts))
+        self.assertTrue(all(0.1 < a < 0.1 + 1000 * main.PAYMENT_AMOUNT_STEP for a in amounts))
+        stored = [self.campaign(campaign_id)['amount'] for campaign_id, _ in orders]
+        self.assertEqual(stored, amounts)
+
+    def test_networks_without_rpc_keep_the_list_price(self):
+        campaign_id, amount = self.run_async(main.campaign_scheduler.create_order(1, "bsc", "0xtoken", "3h", 0.5))
+        self.assertEqual(amount, 0.5)
+        self.assertEqual(self.campaign(campaign_id)['amount'], 0.5)
+
+    # ---------------- Support reports ----------------
+    def test_unmatched_payment_is_reported_to_support(self):
+        self.set_cursor("solana", "S0")
+        self.stub(
+            signatures=[{"signature": "S1", "memo": "<order 5>"}, {"signature": "S0"}],
+            transactions={"S1": sol_transfer(lamports(0.123))},
+        )
+        support, main.SUPPORT_CHAT = main.SUPPORT_CHAT, "-100123"
+        try:
+            self.run_async(self.watcher.poll_solana("solana", "stub", SOL_WALLET))
+        finally:
+            main.SUPPORT_CHAT = support
+        self.assertEqual(self.watcher.unmatched, 1)
+        [(chat, text)] = self.sent
+        self.assertEqual(chat, "-100123")
+        self.assertIn("UNMATCHED PAYMENT", text)
+        self.assertIn("0.123", text)
+        self.assertIn("&lt;order 5&gt;", text)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import tempfile
+import unittest
+
+# main.py reads its settings at import time
+os.environ.setdefault("BOT_TOKEN", "123456:TESTTESTTESTTESTTESTTESTTESTTESTTEST")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="omnitrending-test-"), "test.db"))
+os.environ.setdefault("METRICS_PORT", "0")
+
+from aiogram.dispatcher.storage import DisabledStorage
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
+
+import main
+
+# Set to a disposable Redis (e.g. a local redis-server) to run the round trip against it
+TEST_REDIS_URL = os.getenv("TEST_REDIS_URL")
+
+class SQLiteStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.run_async(main.run_db(self._reset_db))
+
+    @staticmethod
+    def _reset_db():
+        main.SQLiteStorage(flush_interval=0)  # creates the table
+        db = main.get_db()
+        with db:
+            db.execute("DELETE FROM fsm_sessions")
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_storage_is_not_created_at_import(self):
+        self.assertIsInstance(main.dp.storage, DisabledStorage)
+
+    def test_sessions_survive_a_restart(self):
+        async def write():
+            storage = main.SQLiteStorage(flush_interval=0)
+            await storage.set_state(chat=1, user=1, state="UserState:waiting_for_package")
+            await storage.update_data(chat=1, user=1, network="solana", amount=0.25)
+            await storage.close()
+
+        async def read():
+            storage = main.SQLiteStorage()
+            return await storage.get_state(chat=1, user=1), await storage.get_data(chat=1, user=1)
+
+        self.run_async(write())
+        state, data = self.run_async(read())
+        self.assertEqual(state, "UserState:waiting_for_package")
+        self.assertEqual(data, {"network": "solana", "amount": 0.25})
+
+    def test_shard_restores_only_its_own_users(self):
+        async def write():
+            storage = main.SQLiteStorage(flush_interval=0)
+            for user in range(1, 7):
+                await storage.set_state(chat=user, user=user, state="UserState:waiting_for_contract")
+            await storage.close()
+
+        self.run_async(write())
+        settings = main.SHARDS, main.SHARD_ID
+        main.SHARDS, main.SHARD_ID = 3, 1
+        try:
+            storage = main.SQLiteStorage()
+        finally:
+            main.SHARDS, main.SHARD_ID = settings
+        self.assertEqual(sorted(user for _, user in storage.data), ["1", "4"])
+
+    def test_idle_sessions_expire(self):
+        async def go():
+            storage = main.SQLiteStorage(ttl=60, flush_interval=0)
+            await storage.set_state(chat=1, user=1, state="UserState:waiting_for_contract")
+            storage.data[("1", "1")]['touched'] -= 120
+            return await storage.get_state(chat=1, user=1)
+        self.assertIsNone(self.run_async(go()))
+
+class RedisStorageTest(unittest.TestCase):
+    def setUp(self):
+        self._settings = main.FSM_STORAGE, main.FSM_REDIS_URL
+
+    def tearDown(self):
+        main.FSM_STORAGE, main.FSM_REDIS_URL = self._settings
+
+    def test_redis_url_is_parsed(self):
+        main.FSM_STORAGE, main.FSM_REDIS_URL = "redis", "redis://:secret@cache.internal:6380/2"
+        storage = main.create_storage()
+        self.assertIsInstance(storage, RedisStorage2)
+        kwargs = storage._redis.connection_pool.connection_kwargs
+        self.assertEqual((kwargs["host"], kwargs["port"], kwargs["db"], kwargs["password"]),
+                         ("cache.internal", 6380, 2, "secret"))
+
+    @unittest.skipUnless(TEST_REDIS_URL, "TEST_REDIS_URL not set")
+    def test_round_trip(self):
+        main.FSM_STORAGE, main.FSM_REDIS_URL = "redis", TEST_REDIS_URL
+
+        async def go():
+            storage = main.create_storage()
+            try:
+                await storage.set_state(chat=7, user=7, state="UserState:waiting_for_tx")
+                await storage.update_data(chat=7, user=7, network="ethereum")
+                other = main.create_storage()  # a second process sees the same session
+                result = await other.get_state(chat=7, user=7), await other.get_data(chat=7, user=7)
+                await other.close()
+                await storage.reset_state(chat=7, user=7)
+                return result
+            finally:
+                await storage.close()
+
+        self.assertEqual(self.run_async(go()), ("UserState:waiting_for_tx", {"network": "ethereum"}))
+
+if __name__ == "__main__":
+    unittest.main()